@@ -0,0 +1,311 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from psycopg2.extensions import cursor
+
+from db_worker import DBWorker
+from http_worker import ApiHandler, CurrencyUpdater
+from main import Synchronizer
+from metrics import STAGE_LATENCY
+
+
+class CountingCursor(cursor):
+    """
+    Cursor counts statements sent to DB
+    """
+    queries = 0
+    lock = threading.Lock()
+
+    @classmethod
+    def count(cls) -> None:
+        with cls.lock:
+            cls.queries += 1
+
+    def execute(self, query, vars=None):
+        self.count()
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        self.count()
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        self.count()
+        return super().copy_expert(sql, file, size)
+
+
+class FakeRequest:
+    def __init__(self, service, result):
+        self.service = service
+        self.result = result
+
+    def execute(self):
+        self.service.count()
+        time.sleep(self.service.latency)
+        return self.result()
+
+
+class FakeSheetsService:
+    """
+    Local stand-in of sheets service generating synthetic rows on demand,
+    every changed_every row gets another price
+    """
+    def __init__(self, rows, latency=0.0, changed_every=0):
+        self.rows = rows
+        self.latency = latency
+        self.changed_every = changed_every
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def count(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def row(self, number) -> list:
+        price = 100 + number * 7919 % 900
+        if self.changed_every and number % self.changed_every == 0:
+            price += 1
+        return [
+            str(number + 1),
+            str(1000000 + number),
+            str(price),
+            f'{1 + number % 28:02d}.{1 + number % 12:02d}.2023',
+        ]
+
+    def rows_of(self, range_) -> list:
+        first, last = (int(row) for row in range_.split(':'))
+        last = min(last, self.rows + 1)
+        return [self.row(row - 2) for row in range(first, last + 1)]
+
+    def get(self, spreadsheetId, fields=None):
+        return FakeRequest(self, lambda: {'sheets': [{'properties': {
+            'gridProperties': {'rowCount': self.rows + 1}
+        }}]})
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension='ROWS'):
+        return FakeRequest(self, lambda: {'valueRanges': [
+            {'values': self.rows_of(range_)} for range_ in ranges
+        ]})
+
+
+class FakeApiHandler(ApiHandler):
+    """
+    ApiHandler reading FakeSheetsService
+    """
+    def __init__(self, service, page_size=1000, concurrency=1):
+        super().__init__(
+            'fake', 'fake', page_size, concurrency=concurrency
+        )
+        self.fake_service = service
+
+    def get_service(self, timeout):
+        return self.fake_service
+
+
+class FakeCbrServer:
+    """
+    Local stand-in of cbr.ru XML_dynamic.asp answering after latency
+    """
+    def __init__(self, latency=0.0, rate='81,1371'):
+        self.latency = latency
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.latency)
+                body = (
+                    f'<?xml version="1.0" encoding="windows-1251"?>'
+                    f'<ValCurs ID="R01235">'
+                    f'<Record Date="{datetime.today():%d.%m.%Y}" '
+                    f'Id="R01235"><Nominal>1</Nominal>'
+                    f'<Value>{rate}</Value></Record></ValCurs>'
+                ).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def stage_totals() -> dict:
+    with STAGE_LATENCY.lock:
+        return {
+            key[0]: total
+            for key, (counts, count, total) in STAGE_LATENCY.values.items()
+        }
+
+
+def run_cycle(synchronizer, service) -> dict:
+    """
+    Function runs one sync cycle against service and return its figures
+    """
+    synchronizer.api_handler.fake_service = service
+    CountingCursor.queries = 0
+    stages = stage_totals()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        success = synchronizer.sync()
+    cycle_time = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'success': success,
+        'cycle_time': round(cycle_time, 4),
+        'rows_per_second': round(service.rows / cycle_time, 1),
+        'peak_memory_mb': round(peak_memory / 1024 / 1024, 2),
+        'queries': CountingCursor.queries,
+        'sheet_requests': service.requests,
+        'stages': {
+            stage: round(total - stages.get(stage, 0), 4)
+            for stage, total in stage_totals().items()
+            if total != stages.get(stage, 0)
+        },
+    }
+
+
+def run(rows, args) -> dict:
+    """
+    Function syncs sheet of rows rows in empty table,
+    syncs it again unchanged and with 1% of changed rows
+    """
+    db_worker = DBWorker(
+        host=args.host, database=args.database,
+        cursor_factory=CountingCursor
+    )
+    conn = db_worker.getconn()
+    with conn.cursor() as cur:
+        cur.execute('DROP TABLE IF EXISTS orders CASCADE;')
+    conn.commit()
+    db_worker.putconn(conn)
+    db_worker.create_table()
+
+    results = {}
+    with FakeCbrServer(args.cbr_latency) as cbr:
+        synchronizer = Synchronizer(
+            'fake', 'fake',
+            copy_threshold=args.copy_threshold,
+            currency_updater=CurrencyUpdater(
+                url=cbr.url, rate_store=db_worker
+            ),
+            db_worker=db_worker
+        )
+        synchronizer.api_handler = FakeApiHandler(
+            None, args.page_size, args.concurrency
+        )
+        for scenario, changed_every in (
+            ('insert', 0), ('unchanged', 0), ('changed', 100)
+        ):
+            service = FakeSheetsService(
+                rows, args.sheet_latency, changed_every
+            )
+            results[f'{rows}/{scenario}'] = run_cycle(synchronizer, service)
+        synchronizer.close()
+        results[f'{rows}/insert']['cbr_requests'] = cbr.requests
+    return results
+
+
+def compare(results, baseline, tolerance) -> list:
+    """
+    Function return regressions of cycle time and peak memory
+    exceeding baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for figure in ('cycle_time', 'peak_memory_mb', 'queries'):
+            if result[figure] > base[figure] * (1 + tolerance):
+                regressions.append(
+                    f'{name} {figure}: {base[figure]} -> {result[figure]}'
+                )
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark of sync cycle with local fakes of '
+                    'Google Sheets and cbr.ru against local Postgres'
+    )
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--sheet-latency', type=float, default=0.05)
+    parser.add_argument('--cbr-latency', type=float, default=0.05)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--copy-threshold', type=int, default=50000)
+    parser.add_argument('--host', default=os.environ.get('POSTGRES_HOST'))
+    parser.add_argument('--database', default='orders_test')
+    parser.add_argument('--save', help='file to save results as baseline')
+    parser.add_argument('--compare', help='baseline file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = {}
+    for rows in args.rows:
+        results.update(run(rows, args))
+
+    for name, result in results.items():
+        print(
+            f'{name:>20} {result["cycle_time"]:>9.3f} s '
+            f'{result["rows_per_second"]:>11.1f} rows/s '
+            f'{result["peak_memory_mb"]:>9.2f} MB '
+            f'{result["queries"]:>6} queries '
+            f'{result["sheet_requests"]:>6} sheet requests'
+        )
+
+    if args.save:
+        with open(args.save, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,102 +1,593 @@
-import inspect
-from typing import List
+import copy
+import csv
+import hashlib
+import io
+import re
+import time
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from typing import Iterable, List, Optional
 
 import psycopg2.pool as pool
-from psycopg2 import DatabaseError
-from psycopg2.errors import UndefinedTable
+from psycopg2 import DatabaseError, InterfaceError, OperationalError
+from psycopg2.extras import execute_values
+from psycopg2.errors import UndefinedColumn, UndefinedTable
 
 from http_worker import Logger
+from metrics import POOL_CONNECTIONS
+
+
+SCHEMA_VERSION = 3
+MIGRATION_LOCK = 7_260_415
+TABLE_NAME = re.compile(r'[a-z_][a-z0-9_]{0,50}')
+# price_rur is the latest known rate applied to price_usd,
+# price_rur_on_delivery is the rate on delivery date,
+# so a new rate is one row of currency_rates instead of rewriting orders.
+# {table} is orders table, its view is {table}_rur
+QUERY_CURRENCY_RATES = (
+    'CREATE TABLE IF NOT EXISTS currency_rates '
+    '(code varchar NOT NULL, '
+    'date date NOT NULL, '
+    'rate numeric NOT NULL, '
+    'PRIMARY KEY (code, date)); '
+    'CREATE OR REPLACE VIEW {table}_rur AS '
+    'SELECT o.id, o.row_num, o.order_id, o.price_usd, o.delivery_data, '
+    'round(o.price_usd * (SELECT r.rate FROM currency_rates r '
+    "WHERE r.code = 'R01235' AND r.date <= current_date "
+    'ORDER BY r.date DESC LIMIT 1), 2) AS price_rur, '
+    'round(o.price_usd * d.rate, 2) AS price_rur_on_delivery '
+    'FROM {table} o LEFT JOIN LATERAL '
+    '(SELECT r.rate FROM currency_rates r '
+    "WHERE r.code = 'R01235' AND r.date <= o.delivery_data "
+    'ORDER BY r.date DESC LIMIT 1) d ON true;'
+)
+
+
+def parse_price(value) -> Optional[Decimal]:
+    """
+    Function returns price of sheet cell or None if it is not a number
+    """
+    try:
+        price = Decimal(
+            str(value).strip().replace(' ', '').replace(',', '.')
+        )
+    except InvalidOperation:
+        return None
+    return price if price.is_finite() else None
+
+
+def parse_date(value) -> Optional[date]:
+    """
+    Function returns date of sheet cell in DD.MM.YYYY
+    or None if it is not a date
+    """
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(str(value).strip(), '%d.%m.%Y').date()
+    except ValueError:
+        return None
+
+
+def parse_order(order: list) -> list:
+    """
+    Function converts sheet row to row of orders table
+    [row_num, order_id, price_usd, delivery_data],
+    unparseable price and date become None,
+    raises ValueError if row number or order id is not an integer
+    """
+    row_num, order_id, price_usd, delivery_data = (list(order) + [''] * 4)[:4]
+    return [
+        int(row_num), int(order_id), parse_price(price_usd),
+        parse_date(delivery_data)
+    ]
+
+
+def order_hash(order: list) -> str:
+    """
+    Function returns content hash of order row as it is written in DB
+    """
+    return hashlib.md5(
+        '\x1f'.join(str(value) for value in order).encode()
+    ).hexdigest()
 
 
 class DBWorker(Logger):
-    def __init__(self, host='db', database='orders'):
-        self.pg_pool = pool.SimpleConnectionPool(
-            1,
-            2,
+    """
+    Class handler requests to DB through thread safe pool of connections
+    which lives as long as the worker, use close() or with statement
+    to release connections. Orders are kept in table, for_table()
+    returns worker of another table sharing the pool
+    """
+    def __init__(self, host='db', database='orders', minconn=2, maxconn=4,
+                 check_interval=30, table='orders', **connect_kwargs):
+        self.table = self.check_table(table)
+        self.pg_pool = pool.ThreadedConnectionPool(
+            minconn,
+            maxconn,
             host=host,
             port=5432,
             user='postgres',
             database=database,
-            password='123'
+            password='123',
+            **connect_kwargs
         )
+        self.maxconn = maxconn
+        self.check_interval = check_interval
+        self.last_used = {}
+        POOL_CONNECTIONS.set_function(self.pool_usage)
+
+    @staticmethod
+    def check_table(table: str) -> str:
+        """
+        Function returns table name or raises ValueError
+        if it is not a lowercase SQL identifier
+        """
+        if not TABLE_NAME.fullmatch(table):
+            raise ValueError(f'Invalid table name: {table!r}')
+        return table
+
+    def for_table(self, table: str):
+        """
+        Function returns worker of table sharing pool of connections
+        """
+        worker = copy.copy(self)
+        worker.table = self.check_table(table)
+        return worker
+
+    def pool_usage(self) -> dict:
+        """
+        Function return numbers of used and idle connections of the pool
+        """
+        return {
+            ('used', ): len(self.pg_pool._used),
+            ('idle', ): len(self.pg_pool._pool),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Function closes all connections of the pool
+        """
+        if not self.pg_pool.closed:
+            self.pg_pool.closeall()
+
+    def is_alive(self, conn) -> bool:
+        """
+        Function checks connection idle longer than check_interval
+        with a round trip to DB
+        """
+        if conn.closed:
+            return False
+        last_used = self.last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+            return True
+        except (OperationalError, InterfaceError):
+            return False
+
+    def getconn(self):
+        """
+        Function checks out validated connection,
+        broken connections are closed and replaced by new ones
+        """
+        for _ in range(self.maxconn):
+            conn = self.pg_pool.getconn()
+            if self.is_alive(conn):
+                return conn
+            self.last_used.pop(id(conn), None)
+            self.pg_pool.putconn(conn, close=True)
+        return self.pg_pool.getconn()
+
+    def putconn(self, conn) -> None:
+        """
+        Function returns connection to the pool,
+        the pool rolls back unfinished transaction
+        and keeps up to minconn idle connections
+        """
+        self.last_used[id(conn)] = time.monotonic()
+        self.pg_pool.putconn(conn)
+        if conn.closed:
+            self.last_used.pop(id(conn), None)
 
     def create_table(self) -> None:
         """
         Function create table in DB to save data
+        or migrates existing one to SCHEMA_VERSION
         """
+        self.migrate()
 
-        query = (
-            'CREATE TABLE IF NOT EXISTS orders '
+    def migrate(self) -> None:
+        """
+        Function brings table to SCHEMA_VERSION under advisory lock:
+        creates the table if it doesn't exist or applies migrations
+        in order, table without recorded version has version 1
+        (untyped varchar columns). Versions are recorded by table
+        """
+        migrations = {
+            2: self.migrate_typed_columns,
+            3: self.migrate_currency_rates,
+        }
+        query_create = (
+            f'CREATE TABLE IF NOT EXISTS {self.table} '
             '(id serial PRIMARY KEY, '
             'row_num integer, '
             'order_id integer UNIQUE, '
-            'price_usd varchar, '
-            'delivery_data varchar, '
-            'price_rur varchar);'
+            'price_usd numeric, '
+            'delivery_data date, '
+            'row_hash varchar); '
+            f'CREATE INDEX IF NOT EXISTS {self.table}_delivery_data_idx '
+            f'ON {self.table} (delivery_data); '
+            f'{QUERY_CURRENCY_RATES.format(table=self.table)}'
         )
 
+        conn = self.getconn()
+        cur = conn.cursor()
         try:
-            conn = self.pg_pool.getconn()
-            cur = conn.cursor()
-            cur.execute(query)
+            cur.execute('SELECT pg_advisory_lock(%s);', (MIGRATION_LOCK, ))
+            cur.execute(
+                'CREATE TABLE IF NOT EXISTS schema_version '
+                '(version integer NOT NULL); '
+                'ALTER TABLE schema_version ADD COLUMN IF NOT EXISTS '
+                "table_name varchar NOT NULL DEFAULT 'orders';"
+            )
+            cur.execute('SELECT to_regclass(%s) IS NOT NULL;', (self.table, ))
+            exists = cur.fetchone()[0]
+            cur.execute(
+                'SELECT max(version) FROM schema_version '
+                'WHERE table_name = %s;', (self.table, )
+            )
+            version = cur.fetchone()[0] or 1
+            conn.commit()
+
+            if not exists:
+                cur.execute(query_create)
+                self.set_schema_version(cur, SCHEMA_VERSION)
+                conn.commit()
+                return None
+
+            for number in range(version + 1, SCHEMA_VERSION + 1):
+                migrations[number]()
+                self.set_schema_version(cur, number)
+                conn.commit()
+
+        except DatabaseError as e:
+            conn.rollback()
+            self.log_error(e)
+
+        finally:
+            try:
+                cur.execute(
+                    'SELECT pg_advisory_unlock(%s);', (MIGRATION_LOCK, )
+                )
+                conn.commit()
+            except DatabaseError:
+                pass
+            cur.close()
+            self.putconn(conn)
+
+    def set_schema_version(self, cur, version) -> None:
+        cur.execute(
+            'DELETE FROM schema_version WHERE table_name = %s;', (self.table, )
+        )
+        cur.execute(
+            'INSERT INTO schema_version (version, table_name) '
+            'VALUES (%s, %s);', (version, self.table)
+        )
+
+    def migrate_typed_columns(self, batch_size=10000) -> None:
+        """
+        Function moves price_usd, delivery_data and price_rur
+        from varchar to numeric and date without long table locks:
+        typed columns are added, backfilled by batches of id in short
+        transactions and swapped with varchar ones in one short
+        transaction, unparseable values become NULL,
+        index on delivery_data is built concurrently.
+        Runs before sync starts, so rows are not written meanwhile
+        """
+        query_type = (
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = %s AND column_name = 'price_usd';"
+        )
+        query_add = (
+            f'ALTER TABLE {self.table} '
+            'ADD COLUMN IF NOT EXISTS row_hash varchar, '
+            'ADD COLUMN IF NOT EXISTS price_usd_typed numeric, '
+            'ADD COLUMN IF NOT EXISTS delivery_data_typed date, '
+            'ADD COLUMN IF NOT EXISTS price_rur_typed numeric;'
+        )
+        query_batch = 'SELECT id, price_usd, delivery_data, price_rur ' \
+                      f'FROM {self.table} WHERE id > %s ' \
+                      'ORDER BY id LIMIT %s;'
+        query_backfill = f'UPDATE {self.table} o SET ' \
+                         'price_usd_typed = v.price_usd, ' \
+                         'delivery_data_typed = v.delivery_data, ' \
+                         'price_rur_typed = v.price_rur ' \
+                         'FROM (VALUES %s) AS v ' \
+                         '(id, price_usd, delivery_data, price_rur) ' \
+                         'WHERE o.id = v.id;'
+        query_swap = (
+            "SET LOCAL lock_timeout = '5s'; "
+            f'ALTER TABLE {self.table} DROP COLUMN price_usd, '
+            'DROP COLUMN delivery_data, DROP COLUMN price_rur; '
+            f'ALTER TABLE {self.table} '
+            'RENAME COLUMN price_usd_typed TO price_usd; '
+            f'ALTER TABLE {self.table} '
+            'RENAME COLUMN delivery_data_typed TO delivery_data; '
+            f'ALTER TABLE {self.table} '
+            'RENAME COLUMN price_rur_typed TO price_rur;'
+        )
+        query_index = 'CREATE INDEX CONCURRENTLY IF NOT EXISTS ' \
+                      f'{self.table}_delivery_data_idx ' \
+                      f'ON {self.table} (delivery_data);'
+
+        conn = self.getconn()
+        cur = conn.cursor()
+        try:
+            cur.execute(query_type, (self.table, ))
+            typed = cur.fetchone()[0] == 'numeric'
+            conn.commit()
+            if not typed:
+                cur.execute(query_add)
+                conn.commit()
+                last_id = 0
+                while True:
+                    cur.execute(query_batch, (last_id, batch_size))
+                    batch = cur.fetchall()
+                    if not batch:
+                        break
+                    execute_values(
+                        cur,
+                        query_backfill,
+                        [
+                            (row_id, parse_price(price_usd),
+                             parse_date(delivery_data),
+                             parse_price(price_rur))
+                            for row_id, price_usd, delivery_data, price_rur
+                            in batch
+                        ],
+                        template='(%s, %s::numeric, %s::date, %s::numeric)',
+                        page_size=batch_size
+                    )
+                    conn.commit()
+                    last_id = batch[-1][0]
+                cur.execute(query_swap)
+                conn.commit()
+
+            conn.autocommit = True
+            cur.execute(query_index)
+
+        except DatabaseError:
+            conn.rollback()
+            raise
+
+        finally:
+            conn.autocommit = False
+            cur.close()
+            self.putconn(conn)
+
+    def migrate_currency_rates(self) -> None:
+        """
+        Function creates currency_rates table and {table}_rur view
+        and drops price_rur stored in table,
+        RUB prices are derived from rates on read since then
+        """
+        conn = self.getconn()
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SET LOCAL lock_timeout = '5s'; "
+                f'ALTER TABLE {self.table} DROP COLUMN IF EXISTS price_rur; '
+                f'{QUERY_CURRENCY_RATES.format(table=self.table)}'
+            )
             conn.commit()
+
+        except DatabaseError:
+            conn.rollback()
+            raise
+
+        finally:
             cur.close()
-            self.pg_pool.putconn(conn)
+            self.putconn(conn)
+
+    def save_rates(self, code: str, rates: list) -> int:
+        """
+        Function writes list of (date, rate) of currency code
+        in currency_rates, only new and changed rates are written.
+        Returns number of written rows
+        """
+        if not rates:
+            return 0
+        conn = self.getconn()
+        cur = conn.cursor()
+        query = 'INSERT INTO currency_rates (code, date, rate) ' \
+                'VALUES %s ON CONFLICT (code, date) DO UPDATE SET ' \
+                'rate = EXCLUDED.rate ' \
+                'WHERE currency_rates.rate IS DISTINCT FROM EXCLUDED.rate ' \
+                'RETURNING date;'
+        try:
+            res = execute_values(
+                cur,
+                query,
+                [(code, date_, Decimal(str(rate))) for date_, rate in rates],
+                fetch=True
+            )
+            conn.commit()
+            return len(res)
+
+        except UndefinedTable as e:
+            conn.rollback()
+            self.log_error(e)
+            self.create_table()
 
         except DatabaseError as e:
-            self.write_log(inspect.stack()[0][3], e)
-            return None
+            conn.rollback()
+            self.log_error(e)
+
+        finally:
+            cur.close()
+            self.putconn(conn)
+        return 0
 
     def retrieve_orders_from_db(self):
-        conn = self.pg_pool.getconn()
+        conn = self.getconn()
         cur = conn.cursor()
 
         try:
             cur.execute(
-                """Select order_id FROM orders;""",
+                f"""Select order_id FROM {self.table};""",
             )
             order_in_db = [order[0] for order in cur.fetchall()]
             return order_in_db
 
         except UndefinedTable as e:
-            self.write_log(inspect.stack()[0][3], e)
+            self.log_error(e)
             self.create_table()
 
         except DatabaseError as e:
-            self.write_log(inspect.stack()[0][3], e)
+            self.log_error(e)
 
         finally:
             cur.close()
-            self.pg_pool.putconn(conn)
+            self.putconn(conn)
         return []
 
-    def delete_orders_from_db(self, orders: List[int]) -> None:
-        conn = self.pg_pool.getconn()
+    def retrieve_hashes_from_db(self) -> dict:
+        """
+        Function returns content hashes of orders in DB by order_id
+        """
+        conn = self.getconn()
         cur = conn.cursor()
-        query = 'DELETE from orders WHERE order_id IN %s;'
+
         try:
             cur.execute(
-                query,
-                (tuple(orders), ))
+                f"""Select order_id, row_hash FROM {self.table};""",
+            )
+            return dict(cur.fetchall())
+
+        except (UndefinedTable, UndefinedColumn) as e:
+            conn.rollback()
+            self.log_error(e)
+            self.create_table()
+
+        except DatabaseError as e:
+            conn.rollback()
+            self.log_error(e)
+
+        finally:
+            cur.close()
+            self.putconn(conn)
+        return {}
+
+    def delete_orders_from_db(self, orders: List[int],
+                              chunk_size: int = 10000) -> None:
+        """
+        Function deletes orders by order_id in chunks of chunk_size
+        passed as one array parameter each
+        """
+        conn = self.getconn()
+        cur = conn.cursor()
+        query = f'DELETE from {self.table} WHERE order_id = ANY(%s);'
+        try:
+            for first in range(0, len(orders), chunk_size):
+                cur.execute(
+                    query,
+                    (list(orders[first:first + chunk_size]), ))
             conn.commit()
 
         except UndefinedTable as e:
-            self.write_log(inspect.stack()[0][3], e)
+            self.log_error(e)
             self.create_table()
 
         except DatabaseError as e:
-            self.write_log(inspect.stack()[0][3], e)
+            self.log_error(e)
 
         finally:
             cur.close()
-            self.pg_pool.putconn(conn)
+            self.putconn(conn)
+
+    def delete_missing_orders(self, order_ids: Iterable[int],
+                              chunk_size: int = 10000) -> List[int]:
+        """
+        Function deletes orders whose order_id is not in order_ids.
+        Ids are copied in temporary table by chunks, vanished orders
+        are found by one anti-join and deleted in chunks of chunk_size,
+        each chunk in its own transaction.
+        Returns list of deleted order_id
+        """
+        conn = self.getconn()
+        cur = conn.cursor()
+        query_ids = 'DROP TABLE IF EXISTS sheet_ids, vanished_ids; ' \
+                    'CREATE TEMP TABLE sheet_ids (order_id integer);'
+        query_copy = 'COPY sheet_ids (order_id) FROM STDIN;'
+        query_vanished = 'ANALYZE sheet_ids; ' \
+                         'CREATE TEMP TABLE vanished_ids AS ' \
+                         f'SELECT o.order_id FROM {self.table} o ' \
+                         'WHERE NOT EXISTS (SELECT 1 FROM sheet_ids s ' \
+                         'WHERE s.order_id = o.order_id);'
+        query_delete = 'WITH chunk AS (DELETE FROM vanished_ids ' \
+                       'WHERE ctid IN (SELECT ctid FROM vanished_ids ' \
+                       'LIMIT %s) RETURNING order_id) ' \
+                       f'DELETE FROM {self.table} o USING chunk c ' \
+                       'WHERE o.order_id = c.order_id ' \
+                       'RETURNING o.order_id;'
+        deleted = []
+        try:
+            cur.execute(query_ids)
+            order_ids = iter(order_ids)
+            while True:
+                chunk = list(islice(order_ids, chunk_size))
+                if not chunk:
+                    break
+                cur.copy_expert(query_copy, io.StringIO(
+                    ''.join(f'{order_id}\n' for order_id in chunk)
+                ))
+            cur.execute(query_vanished)
+            cur.execute('SELECT count(*) FROM vanished_ids;')
+            vanished = cur.fetchone()[0]
+            conn.commit()
+            for _ in range(0, vanished, chunk_size):
+                cur.execute(query_delete, (chunk_size, ))
+                chunk = [order[0] for order in cur.fetchall()]
+                conn.commit()
+                deleted += chunk
+            return deleted
+
+        except UndefinedTable as e:
+            conn.rollback()
+            self.log_error(e)
+            self.create_table()
+
+        except DatabaseError as e:
+            conn.rollback()
+            self.log_error(e)
+
+        finally:
+            try:
+                cur.execute('DROP TABLE IF EXISTS sheet_ids, vanished_ids;')
+                conn.commit()
+            except DatabaseError:
+                conn.rollback()
+            cur.close()
+            self.putconn(conn)
+        return deleted
 
     def insert_order_in_db(self, order: List[int]):
-        conn = self.pg_pool.getconn()
+        conn = self.getconn()
         cur = conn.cursor()
-        query = 'INSERT INTO orders (row_num, order_id, ' \
-                'price_usd, delivery_data, price_rur) ' \
-                'VALUES (%s, %s, %s, %s, %s);'
+        query = f'INSERT INTO {self.table} (row_num, order_id, ' \
+                'price_usd, delivery_data) ' \
+                'VALUES (%s, %s, %s, %s);'
         try:
             cur.execute(
                 query,
@@ -104,19 +595,19 @@ class DBWorker(Logger):
             conn.commit()
             return 1
         except DatabaseError as e:
-            self.write_log(inspect.stack()[0][3], e)
+            self.log_error(e)
             return 0
 
         finally:
             cur.close()
-            self.pg_pool.putconn(conn)
+            self.putconn(conn)
 
     def update_order_in_db(self, order):
-        conn = self.pg_pool.getconn()
+        conn = self.getconn()
         cur = conn.cursor()
-        query = 'UPDATE orders SET row_num = %s, ' \
-                'price_usd = %s, delivery_data = %s, ' \
-                'price_rur = %s WHERE order_id = %s;'
+        query = f'UPDATE {self.table} SET row_num = %s, ' \
+                'price_usd = %s, delivery_data = %s ' \
+                'WHERE order_id = %s;'
         try:
             cur.execute(
                 query,
@@ -125,9 +616,132 @@ class DBWorker(Logger):
             return 1
 
         except DatabaseError as e:
-            self.write_log(inspect.stack()[0][3], e)
+            self.log_error(e)
             return 0
 
         finally:
             cur.close()
-            self.pg_pool.putconn(conn)
+            self.putconn(conn)
+
+    def upsert_orders(self, orders: List[list], page_size: int = 1000):
+        """
+        Function writes orders in one transaction using multi-row
+        INSERT ... ON CONFLICT and returns lists of inserted and
+        updated order_id
+        """
+        rows = {}
+        for order in orders:
+            rows[int(order[1])] = [*order, order_hash(order)]
+        if not rows:
+            return [], []
+
+        conn = self.getconn()
+        cur = conn.cursor()
+        query = f'INSERT INTO {self.table} (row_num, order_id, ' \
+                'price_usd, delivery_data, row_hash) ' \
+                'VALUES %s ON CONFLICT (order_id) DO UPDATE SET ' \
+                'row_num = EXCLUDED.row_num, ' \
+                'price_usd = EXCLUDED.price_usd, ' \
+                'delivery_data = EXCLUDED.delivery_data, ' \
+                'row_hash = EXCLUDED.row_hash ' \
+                f'WHERE {self.table}.row_hash IS DISTINCT FROM ' \
+                'EXCLUDED.row_hash ' \
+                'RETURNING order_id, (xmax = 0);'
+        try:
+            res = execute_values(
+                cur,
+                query,
+                list(rows.values()),
+                page_size=page_size,
+                fetch=True
+            )
+            conn.commit()
+            added = [order_id for order_id, inserted in res if inserted]
+            updated = [order_id for order_id, inserted in res if not inserted]
+            return added, updated
+
+        except UndefinedTable as e:
+            conn.rollback()
+            self.log_error(e)
+            self.create_table()
+
+        except DatabaseError as e:
+            conn.rollback()
+            self.log_error(e)
+
+        finally:
+            cur.close()
+            self.putconn(conn)
+        return [], []
+
+    def merge_orders(self, orders: Iterable[list]):
+        """
+        Function streams orders in temporary staging table with
+        COPY FROM STDIN and merges it in orders in one transaction.
+        Returns lists of inserted, updated and deleted order_id
+        """
+        rows = {}
+        for order in orders:
+            rows[int(order[1])] = [*order, order_hash(order)]
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows.values())
+        buffer.seek(0)
+
+        conn = self.getconn()
+        cur = conn.cursor()
+        query_staging = (
+            'CREATE TEMP TABLE orders_staging '
+            '(row_num integer, '
+            'order_id integer PRIMARY KEY, '
+            'price_usd numeric, '
+            'delivery_data date, '
+            'row_hash varchar) ON COMMIT DROP;'
+        )
+        query_copy = 'COPY orders_staging (row_num, order_id, ' \
+                     'price_usd, delivery_data, row_hash) ' \
+                     'FROM STDIN WITH (FORMAT csv);'
+        query_update = f'UPDATE {self.table} o SET row_num = s.row_num, ' \
+                       'price_usd = s.price_usd, ' \
+                       'delivery_data = s.delivery_data, ' \
+                       'row_hash = s.row_hash ' \
+                       'FROM orders_staging s ' \
+                       'WHERE o.order_id = s.order_id AND ' \
+                       'o.row_hash IS DISTINCT FROM s.row_hash ' \
+                       'RETURNING o.order_id;'
+        query_insert = f'INSERT INTO {self.table} (row_num, order_id, ' \
+                       'price_usd, delivery_data, row_hash) ' \
+                       'SELECT s.row_num, s.order_id, s.price_usd, ' \
+                       's.delivery_data, s.row_hash ' \
+                       'FROM orders_staging s WHERE NOT EXISTS ' \
+                       f'(SELECT 1 FROM {self.table} o ' \
+                       'WHERE o.order_id = s.order_id) ' \
+                       'RETURNING order_id;'
+        query_delete = f'DELETE FROM {self.table} o WHERE NOT EXISTS ' \
+                       '(SELECT 1 FROM orders_staging s ' \
+                       'WHERE s.order_id = o.order_id) ' \
+                       'RETURNING order_id;'
+        try:
+            cur.execute(query_staging)
+            cur.copy_expert(query_copy, buffer)
+            cur.execute(query_update)
+            updated = [order[0] for order in cur.fetchall()]
+            cur.execute(query_insert)
+            added = [order[0] for order in cur.fetchall()]
+            cur.execute(query_delete)
+            deleted = [order[0] for order in cur.fetchall()]
+            conn.commit()
+            return added, updated, deleted
+
+        except UndefinedTable as e:
+            conn.rollback()
+            self.log_error(e)
+            self.create_table()
+
+        except DatabaseError as e:
+            conn.rollback()
+            self.log_error(e)
+
+        finally:
+            cur.close()
+            self.putconn(conn)
+        return [], [], []
@@ -1,5 +1,11 @@
-import inspect
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from xml.etree import ElementTree
 
 import httplib2
 from apiclient.discovery import build
@@ -8,110 +14,380 @@ from googleapiclient.errors import HttpError
 from oauth2client.service_account import ServiceAccountCredentials
 from requests import RequestException
 
+from log_writer import LogWriter
+from metrics import RETRIES, STAGE_LATENCY
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
 
 class Logger:
     """
-    Class writer of logs
+    Class writer of logs, entries are written by background LogWriter
     """
+    log_writer = LogWriter(
+        path=os.environ.get('LOG_FILE', 'log.txt'),
+        json_lines=os.environ.get('LOG_FORMAT') == 'json',
+        max_bytes=int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+        backup_count=int(os.environ.get('LOG_BACKUP_COUNT', 3))
+    )
+
     @staticmethod
     def write_log(func, error=None):
-        with open('log.txt', 'a') as log:
-            log.write(
-                f'While executing '
-                f'function --- {func.upper()} --- error occurs:'
-                f'\n--- {str(error).strip()} ---\n'
-                f'log datatime: {datetime.now()}\n\n'
-            )
+        Logger.log_writer.write(func, error)
+
+    @staticmethod
+    def log_error(error=None):
+        """
+        method logs error with name of the calling function
+        """
+        Logger.log_writer.write(sys._getframe(1).f_code.co_name, error)
 
 
 class ApiHandler(Logger):
     """
     Class handler requests to google API
     """
-    def __init__(self, google_cred, spreadsheet_id):
+    def __init__(self, google_cred, spreadsheet_id,
+                 page_size=1000, batch_size=10, concurrency=1):
         self.CREDENTIALS_FILE = google_cred
         self.spreadsheet_id = spreadsheet_id
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.credentials = None
+        self.local = threading.local()
+
+    def get_service(self, timeout):
+        """
+        method return sheets service built once per thread and timeout,
+        httplib2.Http is not thread safe
+        """
+        service = getattr(self.local, 'service', None)
+        if service is not None and self.local.timeout == timeout:
+            return service
+        if self.credentials is None:
+            from_keyfile = ServiceAccountCredentials.from_json_keyfile_name
+            self.credentials = from_keyfile(self.CREDENTIALS_FILE, SCOPES)
+        httpAuth = self.credentials.authorize(httplib2.Http(
+            timeout=timeout
+        ))
+        self.local.service = build('sheets', 'v4', http=httpAuth)
+        self.local.timeout = timeout
+        return self.local.service
+
+    def retrieve_row_count(self, service):
+        """
+        method return row count of the first sheet from its metadata
+        """
+        sheets = service.spreadsheets().get(
+            spreadsheetId=self.spreadsheet_id,
+            fields='sheets.properties.gridProperties.rowCount'
+        ).execute().get('sheets', [])
+        if not sheets:
+            return 0
+        return sheets[0]['properties']['gridProperties']['rowCount']
+
+    def split_ranges(self, row_count):
+        """
+        method split data rows (header excluded) in ranges of page_size
+        """
+        return [
+            f'{first}:{min(first + self.page_size - 1, row_count)}'
+            for first in range(2, row_count + 1, self.page_size)
+        ]
+
+    def retrieve_ranges(self, service, ranges):
+        """
+        method return rows of ranges requested in one batchGet
+        """
+        with STAGE_LATENCY.time(stage='sheet_page'):
+            value_ranges = service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id,
+                ranges=ranges,
+                majorDimension='ROWS'
+            ).execute().get('valueRanges', [])
+        res = []
+        for value_range in value_ranges:
+            res += value_range.get('values', [])
+        return res
 
     def retrieve_orders(self):
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(
-            self.CREDENTIALS_FILE,
-            [
-                'https://www.googleapis.com/auth/spreadsheets',
-                'https://www.googleapis.com/auth/drive'
-            ]
-        )
-        offset = 0
+        if self.concurrency > 1:
+            return self.retrieve_orders_parallel()
+        ranges = None
+        batch = 0
         res = []
         timeout = 1
         while True:
             try:
-                httpAuth = credentials.authorize(httplib2.Http(
-                    timeout=timeout
-                ))
-                service = build('sheets', 'v4', http=httpAuth)
-
-                rows = f'{2+offset}:{102+offset}'
-                values = service.spreadsheets().values().get(
-                    spreadsheetId=self.spreadsheet_id,
-                    range=rows,
-                    majorDimension='ROWS'
-                ).execute().get('values', [])
-                if not values:
+                service = self.get_service(timeout)
+                if ranges is None:
+                    ranges = self.split_ranges(
+                        self.retrieve_row_count(service)
+                    )
+                chunk = ranges[batch:batch + self.batch_size]
+                if not chunk:
                     break
-                res += values
-                offset += 100
+                res += self.retrieve_ranges(service, chunk)
+                batch += self.batch_size
 
             except TimeoutError as e:
-                self.write_log(inspect.stack()[0][3], e)
+                self.log_error(e)
                 if timeout > 2:
                     return None
                 timeout += 0.5
+                RETRIES.inc(upstream='sheets')
 
             except HttpError as e:
-                self.write_log(inspect.stack()[0][3], e)
+                self.log_error(e)
                 return res
         return res
 
+    def retrieve_chunk(self, chunk):
+        """
+        method return rows of one chunk of ranges or None if not available
+        """
+        timeout = 1
+        while True:
+            try:
+                return self.retrieve_ranges(self.get_service(timeout), chunk)
+
+            except TimeoutError as e:
+                self.log_error(e)
+                if timeout > 2:
+                    return None
+                timeout += 0.5
+                RETRIES.inc(upstream='sheets')
+
+            except HttpError as e:
+                self.log_error(e)
+                return None
+
+    def retrieve_orders_parallel(self):
+        """
+        method requests disjoint chunks of ranges in a pool of
+        concurrency threads and returns rows in sheet order
+        or None if any chunk is not available
+        """
+        try:
+            ranges = self.split_ranges(
+                self.retrieve_row_count(self.get_service(1))
+            )
+        except (TimeoutError, HttpError) as e:
+            self.log_error(e)
+            return None
+
+        chunks = [
+            ranges[batch:batch + self.batch_size]
+            for batch in range(0, len(ranges), self.batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pages = list(executor.map(self.retrieve_chunk, chunks))
+        if any(page is None for page in pages):
+            return None
+        return [row for page in pages for row in page]
+
+
+class ChangeDetector:
+    """
+    Interface of spreadsheet change detection
+    """
+
+    def retrieve_version(self):
+        """
+        method return token which changes with the spreadsheet
+        or None if not available
+        """
+        raise NotImplementedError
+
+
+class DriveChangeDetector(ChangeDetector, Logger):
+    """
+    Class detects spreadsheet changes by version of the drive file
+    """
+    def __init__(self, google_cred, spreadsheet_id, timeout=1):
+        self.CREDENTIALS_FILE = google_cred
+        self.spreadsheet_id = spreadsheet_id
+        self.timeout = timeout
+        self.service = None
+
+    def retrieve_version(self):
+        try:
+            if self.service is None:
+                credentials = ServiceAccountCredentials.\
+                    from_json_keyfile_name(self.CREDENTIALS_FILE, SCOPES)
+                httpAuth = credentials.authorize(httplib2.Http(
+                    timeout=self.timeout
+                ))
+                self.service = build('drive', 'v3', http=httpAuth)
+            return self.service.files().get(
+                fileId=self.spreadsheet_id,
+                fields='version'
+            ).execute().get('version')
+
+        except (TimeoutError, HttpError) as e:
+            self.log_error(e)
+            return None
+
 
 class CurrencyUpdater(Logger):
     """
-    Class handler requests to cbr.ru
+    Class handler requests to cbr.ru,
+    rates are cached by (currency code, date) for ttl seconds,
+    persisted in cache_file if it is set and saved in rate_store
+    (object with save_rates(code, rates), e.g. DBWorker) if it is set
     """
+    def __init__(self, code='R01235', ttl=3600, cache_file=None,
+                 keep_days=31, lookback=10,
+                 url='https://www.cbr.ru/scripts/XML_dynamic.asp',
+                 rate_store=None):
+        self.code = code
+        self.rate_store = rate_store
+        self.url = url
+        self.ttl = ttl
+        self.lookback = lookback
+        self.cache_file = cache_file
+        self.keep_days = keep_days
+        self.cache = self.load_cache()
+
+    def load_cache(self) -> dict:
+        """
+        method return cache stored in cache_file or empty cache
+        """
+        if not self.cache_file:
+            return {}
+        try:
+            with open(self.cache_file) as cache:
+                return json.load(cache)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.log_error(e)
+            return {}
+
+    def save_cache(self) -> None:
+        """
+        method writes cache in cache_file atomically
+        """
+        if not self.cache_file:
+            return None
+        tmp_file = f'{self.cache_file}.tmp'
+        try:
+            with open(tmp_file, 'w') as cache:
+                json.dump(self.cache, cache)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            self.log_error(e)
+
+    def cache_key(self, date) -> str:
+        return f'{self.code}:{date.isoformat()}'
+
+    def get_cached_rate(self, date):
+        """
+        method return cached rate for date or None if missed or expired
+        """
+        entry = self.cache.get(self.cache_key(date))
+        if entry is None or time.time() - entry['fetched'] > self.ttl:
+            return None
+        return entry['rate']
+
+    def cache_rates(self, rates) -> None:
+        """
+        method caches list of (date, rate)
+        and drops entries older than keep_days
+        """
+        if not rates:
+            return None
+        fetched = time.time()
+        for date, rate in rates:
+            self.cache[self.cache_key(date)] = {
+                'rate': rate, 'fetched': fetched
+            }
+        latest = max(date for date, rate in rates)
+        oldest = self.cache_key(latest - timedelta(days=self.keep_days))
+        prefix = f'{self.code}:'
+        self.cache = {
+            key: entry for key, entry in self.cache.items()
+            if not key.startswith(prefix) or key >= oldest
+        }
+        self.save_cache()
 
     def retrieve_currency(self):
         """
         method return currency rate or None if not available
         """
-        offset = 0
+        today = datetime.today().date()
+        rate = self.get_cached_rate(today)
+        if rate is not None:
+            return rate
+        rates = self.retrieve_rates()
+        if not rates:
+            return None
+        rate = rates[-1][1]
+        self.cache_rates(rates + [(today, rate)])
+        if self.rate_store is not None:
+            self.rate_store.save_rates(self.code, rates)
+        return rate
+
+    @staticmethod
+    def parse_rates(content):
+        """
+        method parse XML_dynamic.asp response
+        to list of (date, rate per one unit) sorted by date
+        """
+        rates = []
+        for record in ElementTree.fromstring(content).iter('Record'):
+            date = datetime.strptime(record.get('Date'), '%d.%m.%Y').date()
+            value = float(record.findtext('Value').replace(',', '.'))
+            nominal = int(record.findtext('Nominal') or 1)
+            rates.append((date, value / nominal))
+        return sorted(rates)
+
+    def retrieve_rates(self, lookback=None):
+        """
+        method requests rates of the last lookback days in one request
+        and return list of (date, rate) sorted by date
+        or None if not available
+        """
+        if lookback is None:
+            lookback = self.lookback
+        today = datetime.today()
+        date_req1 = (today - timedelta(days=lookback)).strftime('%d/%m/%Y')
+        date_req2 = today.strftime('%d/%m/%Y')
+        url = f'{self.url}?' \
+              f'date_req1={date_req1}&date_req2={date_req2}&' \
+              f'VAL_NM_RQ={self.code}'
         timeout = 0.1
         error = 0
         msg = 'Status codes of responses'
         while True:
             try:
-                date = (
-                    datetime.today() - timedelta(days=offset)
-                ).strftime('%d/%m/%Y')
-                url = f'https://www.cbr.ru/scripts/XML_dynamic.asp?' \
-                      f'date_req1={date}&date_req2={date}&VAL_NM_RQ=R01235'
                 res_request = requests.get(url, timeout=timeout)
                 if str(res_request.status_code)[0] in ['4', '5']:
                     if error > 4:
                         msg += ' ' + str(res_request.status_code)
-                        self.write_log(inspect.stack()[0][3], msg)
+                        self.log_error(msg)
                         return None
                     msg += ' ' + str(res_request.status_code)
                     error += 1
+                    RETRIES.inc(upstream='cbr')
                     continue
-                if res_request.text.find('<Value>') != -1:
-                    break
-                offset += 1
+                break
 
             except RequestException as e:
-                self.write_log(inspect.stack()[0][3], e)
+                self.log_error(e)
                 if timeout > 0.3:
                     return None
                 timeout += 0.1
-        res_request = res_request.text.split('<Value>')[1].split(
-            '</Value>'
-        )[0].replace(',', '.')
-        return float(res_request)
+                RETRIES.inc(upstream='cbr')
+
+        try:
+            return self.parse_rates(res_request.content)
+
+        except (ElementTree.ParseError, AttributeError,
+                TypeError, ValueError) as e:
+            self.log_error(e)
+            return None
@@ -0,0 +1,113 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+
+class LogWriter:
+    """
+    Class writes log entries in background thread:
+    entries are queued without blocking callers, written and flushed
+    in batches, log file is rotated by size,
+    entries are plain text or JSON lines
+    """
+    def __init__(self, path='log.txt', json_lines=False,
+                 max_bytes=10 * 1024 * 1024, backup_count=3,
+                 batch_size=100, flush_interval=1.0, max_queue=10000):
+        self.path = path
+        self.json_lines = json_lines
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        method starts writer thread once
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return None
+            self.thread = threading.Thread(
+                target=self.run, name='log-writer', daemon=True
+            )
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def write(self, func, error=None) -> None:
+        """
+        method queues entry, entries are dropped while queue is full
+        """
+        self.start()
+        entry = {
+            'time': datetime.now().isoformat(),
+            'function': func,
+            'error': str(error).strip(),
+        }
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self) -> None:
+        """
+        method waits until all queued entries are written
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def format(self, entry) -> str:
+        if self.json_lines:
+            return json.dumps(entry, ensure_ascii=False) + '\n'
+        return (
+            f'While executing '
+            f'function --- {entry["function"].upper()} --- error occurs:'
+            f'\n--- {entry["error"]} ---\n'
+            f'log datatime: {entry["time"]}\n\n'
+        )
+
+    def rotate(self) -> None:
+        """
+        method shifts log.txt -> log.txt.1 -> ... -> log.txt.backup_count
+        """
+        for number in range(self.backup_count - 1, 0, -1):
+            source = f'{self.path}.{number}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{number + 1}')
+        if self.backup_count:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    def write_batch(self, entries) -> None:
+        data = ''.join(self.format(entry) for entry in entries)
+        try:
+            if os.path.exists(self.path) and self.max_bytes and \
+                    os.path.getsize(self.path) + len(data) > self.max_bytes:
+                self.rotate()
+            with open(self.path, 'a') as log:
+                log.write(data)
+        except OSError:
+            self.dropped += len(entries)
+
+    def run(self) -> None:
+        while True:
+            entries = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(entries) < self.batch_size:
+                try:
+                    entries.append(self.queue.get(
+                        timeout=max(0, deadline - time.monotonic())
+                    ))
+                except queue.Empty:
+                    break
+            self.write_batch(entries)
+            for _ in entries:
+                self.queue.task_done()
@@ -1,58 +1,332 @@
-import inspect
 import os
+import re
+import signal
+import sys
 import time
+from concurrent import futures
 
 from db_worker import DBWorker
-from http_worker import ApiHandler, CurrencyUpdater, Logger
+from http_worker import (
+    ApiHandler, CurrencyUpdater, DriveChangeDetector, Logger
+)
+from metrics import (
+    CYCLES, LAST_CYCLE_ROWS, ROWS, STAGE_LATENCY, MetricsServer, timed
+)
+from order_batch import OrderBatch
+from scheduler import Scheduler
 
 
-def main(google_cred, spreadsheet_id, host='db'):
-    while True:
+class Synchronizer(Logger):
+    """
+    Class syncs orders of one spreadsheet in DB cycle by cycle
+    """
+    def __init__(self, google_cred, spreadsheet_id, host='db',
+                 copy_threshold=50000, page_size=1000, concurrency=1,
+                 change_detector=None, currency_updater=None,
+                 db_worker=None):
+        self.copy_threshold = copy_threshold
+        if db_worker is None:
+            db_worker = DBWorker(host=host)
+        self.db_worker = db_worker
+        self.api_handler = ApiHandler(
+            google_cred, spreadsheet_id, page_size, concurrency=concurrency
+        )
+        self.change_detector = change_detector
+        if currency_updater is None:
+            currency_updater = CurrencyUpdater(rate_store=db_worker)
+        self.currency_updater = currency_updater
+        self.executor = futures.ThreadPoolExecutor(max_workers=3)
+        self.synced = None
+
+    def migrate(self) -> None:
+        self.db_worker.migrate()
+
+    def close(self) -> None:
+        """
+        method stops worker threads and closes DB connections
+        """
+        self.executor.shutdown(wait=False)
+        self.db_worker.close()
+
+    def parse_orders(self, orders_in_table) -> OrderBatch:
+        """
+        method converts sheet rows to batch of rows of orders table,
+        rows without integer row number or order id are skipped,
+        unparseable price and date are stored as NULL, both are logged
+        """
+        rows, invalid = OrderBatch.from_rows(orders_in_table)
+        incomplete = rows.incomplete()
+        if invalid:
+            self.log_error(
+                f'Skipped {len(invalid)} rows without integer row number '
+                f'or order id, first of them: {invalid[:10]}'
+            )
+        if incomplete:
+            self.log_error(
+                f'{len(incomplete)} orders have unparseable price or date '
+                f'stored as NULL, first of them: {incomplete[:10]}'
+            )
+        return rows
+
+    def sync(self, remaining=lambda: None, update_currency=True) -> bool:
+        """
+        method runs one sync cycle, waits stages no longer than
+        remaining() seconds and return False if cycle failed.
+        Currency rates are saved by currency updater and applied
+        to prices in DB, so new rate alone doesn't rewrite orders,
+        update_currency=False leaves rates to the caller
+        """
         print('Start updating...')
         start = time.time()
-        currency = CurrencyUpdater().retrieve_currency()
-        orders_in_table = ApiHandler(
-            google_cred, spreadsheet_id
-        ).retrieve_orders()
+        currency_future = futures.Future()
+        currency_future.set_result(None)
+        if update_currency:
+            currency_future = self.executor.submit(
+                timed, 'currency_fetch',
+                self.currency_updater.retrieve_currency
+            )
+        version = None
+        if self.change_detector is not None:
+            version = self.change_detector.retrieve_version()
+        if version is not None and version == self.synced:
+            currency_future.result(remaining())
+            print(
+                f'Spreadsheet not changed. '
+                f'Time execution ---{time.time() - start:0.3f} c---\n'
+            )
+            CYCLES.inc(result='skipped')
+            return True
+        db_worker = self.db_worker
+        orders_future = self.executor.submit(
+            timed, 'sheet_fetch', self.api_handler.retrieve_orders
+        )
+        hashes_future = self.executor.submit(
+            timed, 'db_read', db_worker.retrieve_hashes_from_db
+        )
+        currency_future.result(remaining())
+        orders_in_table = orders_future.result(remaining())
         if not orders_in_table:
             msg = f'End updating due to error. ' \
                   f'Time execution ---{time.time() - start:0.3f} c---\n'
-            Logger.write_log(inspect.stack()[0][3], msg)
+            self.log_error(msg)
             print(msg)
-            continue
-        db_worker = DBWorker(host=host)
-        order_in_db = db_worker.retrieve_orders_from_db()
-        updated = []
-        added = []
-        for order in orders_in_table:
-            if int(order[1]) in order_in_db:
-                args = [order[0], order[2], order[3],
-                        int(order[2]) * currency if currency else '???',
-                        order[1]]
-                db_worker.update_order_in_db(args)
-                updated.append(int(order[1]))
-            else:
-                args = order + [
-                    int(order[2]) * currency if currency else '???'
-                ]
-                db_worker.insert_order_in_db(args)
-                added.append(order[1])
-
-        deleted = list(set(order_in_db) - set(updated))
-        if deleted:
-            db_worker.delete_orders_from_db(deleted)
+            CYCLES.inc(result='failed')
+            return False
+        with STAGE_LATENCY.time(stage='parse'):
+            rows = self.parse_orders(orders_in_table)
+        del orders_in_table
+        if len(rows) >= self.copy_threshold:
+            with STAGE_LATENCY.time(stage='db_write'):
+                added, updated, deleted = db_worker.merge_orders(
+                    rows.values()
+                )
+        else:
+            order_in_db = hashes_future.result(remaining())
+            changed = rows.changed(order_in_db)
+            deleted = rows.vanished(order_in_db)
+            with STAGE_LATENCY.time(stage='db_write'):
+                added, updated = db_worker.upsert_orders(changed)
+                if deleted:
+                    deleted = db_worker.delete_missing_orders(rows.order_id)
+
+        for operation, processed in (('fetched', rows), ('added', added),
+                                     ('updated', updated),
+                                     ('deleted', deleted)):
+            ROWS.inc(len(processed), operation=operation)
+            LAST_CYCLE_ROWS.set(len(processed), operation=operation)
 
         print(f'deleted -> {deleted}')
         print(f'updated -> {updated}')
         print(f'added -> {added}')
+        self.synced = version
+        CYCLES.inc(result='success')
+        STAGE_LATENCY.observe(time.time() - start, stage='cycle')
         print(
             f'Successfully updated. '
             f'Time execution ---{time.time() - start:0.3f} c---\n'
         )
+        return True
+
+
+class MultiSynchronizer(Logger):
+    """
+    Class syncs orders of several spreadsheets, each in its own table,
+    in a pool of workers sharing DB connection pool and currency updater,
+    currency is requested once per cycle, failure of one spreadsheet
+    doesn't stop the others
+    """
+    def __init__(self, google_cred, sources, host='db',
+                 copy_threshold=50000, page_size=1000, concurrency=1,
+                 change_detectors=None, currency_updater=None,
+                 db_worker=None, workers=4):
+        if db_worker is None:
+            db_worker = DBWorker(host=host, maxconn=max(4, 2 * workers))
+        self.db_worker = db_worker
+        if currency_updater is None:
+            currency_updater = CurrencyUpdater(rate_store=db_worker)
+        self.currency_updater = currency_updater
+        change_detectors = change_detectors or {}
+        self.synchronizers = {
+            spreadsheet_id: Synchronizer(
+                google_cred, spreadsheet_id, host, copy_threshold,
+                page_size, concurrency,
+                change_detectors.get(spreadsheet_id), currency_updater,
+                db_worker.for_table(table)
+            )
+            for spreadsheet_id, table in sources.items()
+        }
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers + 1)
+
+    def migrate(self) -> None:
+        for synchronizer in self.synchronizers.values():
+            synchronizer.migrate()
+
+    def close(self) -> None:
+        """
+        method stops worker threads and closes DB connections
+        """
+        self.executor.shutdown(wait=False)
+        for synchronizer in self.synchronizers.values():
+            synchronizer.executor.shutdown(wait=False)
+        self.db_worker.close()
+
+    def sync_one(self, spreadsheet_id, remaining) -> bool:
+        """
+        method syncs one spreadsheet, its errors are logged
+        and return False
+        """
+        try:
+            return self.synchronizers[spreadsheet_id].sync(
+                remaining, update_currency=False
+            )
+        except Exception as e:
+            self.log_error(f'{spreadsheet_id}: {e!r}')
+            return False
+
+    def sync(self, remaining=lambda: None) -> bool:
+        """
+        method runs one sync cycle of all spreadsheets
+        and return False if all of them failed
+        """
+        currency_future = self.executor.submit(
+            timed, 'currency_fetch', self.currency_updater.retrieve_currency
+        )
+        results = dict(zip(
+            self.synchronizers,
+            self.executor.map(
+                self.sync_one, self.synchronizers,
+                [remaining] * len(self.synchronizers)
+            )
+        ))
+        currency_future.result(remaining())
+        failed = [
+            spreadsheet_id for spreadsheet_id, success in results.items()
+            if not success
+        ]
+        if failed:
+            self.log_error(f'Failed spreadsheets: {failed}')
+        return len(failed) < len(results)
+
+
+def parse_sources(value: str) -> dict:
+    """
+    Function parses comma separated spreadsheet_id[:table] to dict
+    {spreadsheet_id: table}, table of the first spreadsheet defaults
+    to orders, of the others to orders_<spreadsheet_id>
+    """
+    sources = {}
+    for source in value.split(','):
+        spreadsheet_id, _, table = source.strip().partition(':')
+        if not spreadsheet_id:
+            continue
+        if not table:
+            table = 'orders' if not sources else re.sub(
+                r'[^a-z0-9_]', '_', f'orders_{spreadsheet_id}'.lower()
+            )[:51]
+        sources[spreadsheet_id] = table
+    return sources
+
+
+def main(google_cred, spreadsheet_id, host='db', copy_threshold=50000,
+         page_size=1000, concurrency=1, change_detector=None,
+         currency_updater=None, scheduler=None, db_worker=None,
+         sources=None, change_detectors=None, workers=4):
+    """
+    Function syncs spreadsheet_id in orders table until it's stopped,
+    spreadsheets of sources {spreadsheet_id: table} are synced
+    in parallel instead if it is set to anything else
+    """
+    if sources and sources != {spreadsheet_id: 'orders'}:
+        synchronizer = MultiSynchronizer(
+            google_cred, sources, host, copy_threshold, page_size,
+            concurrency, change_detectors, currency_updater, db_worker,
+            workers
+        )
+    else:
+        synchronizer = Synchronizer(
+            google_cred, spreadsheet_id, host, copy_threshold, page_size,
+            concurrency, change_detector, currency_updater, db_worker
+        )
+    if scheduler is None:
+        scheduler = Scheduler()
+    try:
+        synchronizer.migrate()
+        while True:
+            scheduler.start_cycle()
+            try:
+                success = synchronizer.sync(scheduler.remaining)
+            except futures.TimeoutError:
+                msg = f'End updating due to cycle time budget ' \
+                      f'---{scheduler.max_cycle_time} c--- exceeded\n'
+                Logger.log_error(msg)
+                print(msg)
+                success = False
+            scheduler.wait(success)
+    finally:
+        synchronizer.close()
 
 
 if __name__ == '__main__':
     google_cred = os.environ.get('GOOGLE_CRED')
     spreadsheet_id = os.environ.get('SPREADSHEET_ID')
     host = os.environ.get('POSTGRES_HOST')
-    main(google_cred, spreadsheet_id, host)
+    copy_threshold = int(os.environ.get('COPY_THRESHOLD', 50000))
+    page_size = int(os.environ.get('SHEET_PAGE_SIZE', 1000))
+    concurrency = int(os.environ.get('SHEET_CONCURRENCY', 1))
+    sources = parse_sources(
+        os.environ.get('SPREADSHEET_IDS') or spreadsheet_id or ''
+    )
+    workers = int(os.environ.get('SYNC_WORKERS', 4))
+    change_detector = None
+    change_detectors = {}
+    if os.environ.get('CHANGE_DETECTION', '1') == '1':
+        change_detector = DriveChangeDetector(google_cred, spreadsheet_id)
+        change_detectors = {
+            source: DriveChangeDetector(google_cred, source)
+            for source in sources
+        }
+    scheduler = Scheduler(
+        interval=float(os.environ.get('SYNC_INTERVAL', 60)),
+        retry_delay=float(os.environ.get('SYNC_RETRY_DELAY', 5)),
+        max_backoff=float(os.environ.get('SYNC_MAX_BACKOFF', 900)),
+        jitter=float(os.environ.get('SYNC_JITTER', 0.1)),
+        max_cycle_time=float(os.environ.get('SYNC_MAX_CYCLE_TIME', 300))
+    )
+    db_worker = DBWorker(
+        host=host,
+        minconn=int(os.environ.get('POSTGRES_POOL_MIN', 2)),
+        maxconn=int(
+            os.environ.get('POSTGRES_POOL_MAX') or max(4, 2 * workers)
+        )
+    )
+    currency_updater = CurrencyUpdater(
+        ttl=int(os.environ.get('CURRENCY_TTL', 3600)),
+        cache_file=os.environ.get('CURRENCY_CACHE_FILE', 'currency.json'),
+        rate_store=db_worker
+    )
+    MetricsServer(port=int(os.environ.get('METRICS_PORT', 8000))).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    main(google_cred, spreadsheet_id, host,
+         copy_threshold, page_size, concurrency, change_detector,
+         currency_updater, scheduler, db_worker, sources, change_detectors,
+         workers)
@@ -0,0 +1,245 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace(
+        '\n', '\\n'
+    ).replace('"', '\\"')
+
+
+class Metric:
+    """
+    Base class of metric keeping values by label values
+    """
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def format_labels(self, key, **extra) -> str:
+        labels = list(zip(self.labelnames, key)) + list(extra.items())
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            f'{name}="{escape(value)}"' for name, value in labels
+        ) + '}'
+
+    def samples(self):
+        """
+        method return list of (name suffix, labels, value)
+        """
+        with self.lock:
+            return [
+                ('', self.format_labels(key), value)
+                for key, value in sorted(self.values.items())
+            ]
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value, **labels) -> None:
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def set_function(self, function) -> None:
+        """
+        method sets function returning dict {label values: value},
+        it is called on every render
+        """
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            values = dict(self.function())
+            with self.lock:
+                self.values = values
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                          1, 2.5, 5, 10, 30, 60, 120, 300)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            counts, count, total = self.values.get(
+                key, ((0, ) * len(self.buckets), 0, 0)
+            )
+            self.values[key] = (
+                tuple(
+                    bucket_count + (value <= bucket)
+                    for bucket_count, bucket in zip(counts, self.buckets)
+                ),
+                count + 1,
+                total + value
+            )
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        context manager observes duration of its block in seconds
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        samples = []
+        for key, (counts, count, total) in values:
+            for bucket, bucket_count in zip(self.buckets, counts):
+                samples.append(
+                    ('_bucket', self.format_labels(key, le=bucket),
+                     bucket_count)
+                )
+            samples.append(
+                ('_bucket', self.format_labels(key, le='+Inf'), count)
+            )
+            samples.append(('_sum', self.format_labels(key), total))
+            samples.append(('_count', self.format_labels(key), count))
+        return samples
+
+
+class Registry:
+    """
+    Class keeps metrics and renders them in Prometheus text format
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+REGISTRY = Registry()
+STAGE_LATENCY = REGISTRY.register(Histogram(
+    'sync_stage_duration_seconds',
+    'Duration of sync cycle stages',
+    ['stage']
+))
+CYCLES = REGISTRY.register(Counter(
+    'sync_cycles_total',
+    'Sync cycles by result',
+    ['result']
+))
+ROWS = REGISTRY.register(Counter(
+    'sync_rows_total',
+    'Rows processed by sync cycles by operation',
+    ['operation']
+))
+LAST_CYCLE_ROWS = REGISTRY.register(Gauge(
+    'sync_last_cycle_rows',
+    'Rows processed by the last sync cycle by operation',
+    ['operation']
+))
+RETRIES = REGISTRY.register(Counter(
+    'upstream_retries_total',
+    'Retried requests to upstream services',
+    ['upstream']
+))
+POOL_CONNECTIONS = REGISTRY.register(Gauge(
+    'db_pool_connections',
+    'Connections of DB pool by state',
+    ['state']
+))
+
+
+def timed(stage, func, *args, **kwargs):
+    """
+    Function calls func observing its duration as stage latency
+    """
+    with STAGE_LATENCY.time(stage=stage):
+        return func(*args, **kwargs)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return None
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header(
+            'Content-Type', 'text/plain; version=0.0.4; charset=utf-8'
+        )
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    """
+    Class serves /metrics in background thread
+    """
+    def __init__(self, port=8000, host='', registry=REGISTRY):
+        handler = type(
+            'Handler', (MetricsHandler, ), {'registry': registry}
+        )
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name='metrics', daemon=True
+        )
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
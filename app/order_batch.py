@@ -0,0 +1,215 @@
+import math
+from array import array
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import compress, zip_longest
+
+from db_worker import order_hash
+
+# missing price is NaN, missing date is ordinal 0 (date.toordinal() >= 1)
+MISSING_DATE = 0
+
+
+def parse_float(value) -> float:
+    """
+    Function returns price of sheet cell or NaN if it is not a number
+    """
+    try:
+        price = float(str(value).strip().replace(' ', '').replace(',', '.'))
+    except ValueError:
+        return math.nan
+    return price if math.isfinite(price) else math.nan
+
+
+def parse_ordinal(value) -> int:
+    """
+    Function returns ordinal of date of sheet cell in DD.MM.YYYY
+    or MISSING_DATE if it is not a date
+    """
+    try:
+        return datetime.strptime(str(value).strip(), '%d.%m.%Y').toordinal()
+    except ValueError:
+        return MISSING_DATE
+
+
+def format_price(price: float):
+    """
+    Function returns price as Decimal of its shortest text
+    or None if it is missing
+    """
+    if math.isnan(price):
+        return None
+    text = repr(price)
+    return Decimal(text[:-2] if text.endswith('.0') else text)
+
+
+class OrderRow:
+    """
+    Class view of one row of OrderBatch, values are read from columns
+    """
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def row_num(self) -> int:
+        return self.batch.row_num[self.index]
+
+    @property
+    def order_id(self) -> int:
+        return self.batch.order_id[self.index]
+
+    @property
+    def price_usd(self):
+        return format_price(self.batch.price_usd[self.index])
+
+    @property
+    def delivery_data(self):
+        ordinal = self.batch.delivery_data[self.index]
+        return None if ordinal == MISSING_DATE else date.fromordinal(ordinal)
+
+    def values(self) -> list:
+        """
+        method return row of orders table
+        [row_num, order_id, price_usd, delivery_data]
+        """
+        return [
+            self.row_num, self.order_id, self.price_usd, self.delivery_data
+        ]
+
+
+class OrderBatch:
+    """
+    Class keeps parsed sheet rows in compact typed columns:
+    row numbers and order ids as integers, prices as doubles (NaN when
+    missing) and delivery dates as ordinals (MISSING_DATE when missing).
+    Pages are converted column by column, every distinct date is parsed
+    once, rows are materialized only when they are written
+    """
+    def __init__(self):
+        self.row_num = array('q')
+        self.order_id = array('q')
+        self.price_usd = array('d')
+        self.delivery_data = array('q')
+        self.dates = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        method return batch of rows and list of skipped rows
+        """
+        batch = cls()
+        skipped = batch.extend(rows)
+        return batch, skipped
+
+    def __len__(self) -> int:
+        return len(self.order_id)
+
+    def __getitem__(self, index) -> OrderRow:
+        if not -len(self) <= index < len(self):
+            raise IndexError('batch index out of range')
+        return OrderRow(self, index % len(self))
+
+    def __iter__(self):
+        return (OrderRow(self, index) for index in range(len(self)))
+
+    @staticmethod
+    def parse_ints(values):
+        """
+        method return integer column and mask of valid values
+        or None as mask if all values are valid
+        """
+        try:
+            return array('q', map(int, values)), None
+        except (TypeError, ValueError, OverflowError):
+            pass
+        mask = []
+        column = array('q')
+        for value in values:
+            try:
+                column.append(int(value))
+                mask.append(True)
+            except (TypeError, ValueError, OverflowError):
+                mask.append(False)
+        return column, mask
+
+    def parse_dates(self, values) -> array:
+        """
+        method return ordinals of dates, every distinct value
+        is parsed once per batch
+        """
+        dates = self.dates
+        for value in set(values) - dates.keys():
+            dates[value] = parse_ordinal(value)
+        return array('q', map(dates.__getitem__, values))
+
+    def extend(self, rows) -> list:
+        """
+        method appends sheet rows to the batch and return list of rows
+        skipped because row number or order id is not an integer
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+        columns = list(zip_longest(*rows, fillvalue=''))[:4]
+        columns += [('', ) * len(rows)] * (4 - len(columns))
+        row_nums, order_ids, prices, dates = columns
+
+        row_num, row_num_mask = self.parse_ints(row_nums)
+        order_id, order_id_mask = self.parse_ints(order_ids)
+        skipped = []
+        if row_num_mask is not None or order_id_mask is not None:
+            mask = [
+                valid_num and valid_id for valid_num, valid_id in zip(
+                    row_num_mask or [True] * len(rows),
+                    order_id_mask or [True] * len(rows)
+                )
+            ]
+            skipped = [row for row, valid in zip(rows, mask) if not valid]
+            row_nums, order_ids, prices, dates = (
+                tuple(compress(column, mask)) for column in columns
+            )
+            row_num, _ = self.parse_ints(row_nums)
+            order_id, _ = self.parse_ints(order_ids)
+
+        self.row_num.extend(row_num)
+        self.order_id.extend(order_id)
+        self.price_usd.extend(map(parse_float, prices))
+        self.delivery_data.extend(self.parse_dates(dates))
+        return skipped
+
+    def incomplete(self) -> list:
+        """
+        method return order ids of rows with missing price or date
+        """
+        return [
+            order_id for order_id, price, ordinal in zip(
+                self.order_id, self.price_usd, self.delivery_data
+            )
+            if math.isnan(price) or ordinal == MISSING_DATE
+        ]
+
+    def values(self):
+        """
+        method yields rows of orders table one by one
+        """
+        for row in self:
+            yield row.values()
+
+    def changed(self, hashes: dict) -> list:
+        """
+        method return rows of orders table whose content hash differs
+        from hashes {order_id: row_hash} stored in DB
+        """
+        return [
+            values for values in self.values()
+            if hashes.get(values[1]) != order_hash(values)
+        ]
+
+    def vanished(self, order_ids) -> list:
+        """
+        method return order ids of order_ids which are not in the batch
+        """
+        return list(set(order_ids).difference(self.order_id))
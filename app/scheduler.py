@@ -0,0 +1,57 @@
+import random
+import time
+
+
+class Scheduler:
+    """
+    Class paces sync cycles:
+    fixed interval between starts of successful cycles,
+    exponential backoff after failed cycles, random jitter
+    and time budget of one cycle
+    """
+    def __init__(self, interval=60, retry_delay=5, backoff=2,
+                 max_backoff=900, jitter=0.1, max_cycle_time=300,
+                 sleep=time.sleep, clock=time.monotonic):
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.max_cycle_time = max_cycle_time
+        self.sleep = sleep
+        self.clock = clock
+        self.failures = 0
+        self.started = clock()
+
+    def start_cycle(self) -> None:
+        self.started = self.clock()
+
+    def remaining(self):
+        """
+        method return seconds left of cycle time budget
+        or None if budget is not limited
+        """
+        if not self.max_cycle_time:
+            return None
+        return max(0, self.max_cycle_time - (self.clock() - self.started))
+
+    def delay(self, success: bool) -> float:
+        """
+        method return seconds to wait before the next cycle
+        """
+        if success:
+            self.failures = 0
+            delay = self.interval - (self.clock() - self.started)
+        else:
+            self.failures += 1
+            delay = min(
+                self.max_backoff,
+                self.retry_delay * self.backoff ** (self.failures - 1)
+            )
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(0, delay)
+
+    def wait(self, success: bool) -> None:
+        delay = self.delay(success)
+        if delay:
+            self.sleep(delay)
@@ -1,10 +1,12 @@
 import os
 import unittest
+from datetime import date
+from decimal import Decimal
 
 import psycopg2
 from psycopg2 import DatabaseError
 
-from db_worker import DBWorker
+from db_worker import DBWorker, order_hash
 
 
 class DbTest(unittest.TestCase):
@@ -29,9 +31,9 @@ class DbTest(unittest.TestCase):
             '(id serial PRIMARY KEY, '
             'row_num integer, '
             'order_id integer UNIQUE, '
-            'price_usd varchar, '
-            'delivery_data varchar, '
-            'price_rur varchar);'
+            'price_usd numeric, '
+            'delivery_data date, '
+            'row_hash varchar);'
         )
         with cls.conn.cursor() as cur:
             cur.execute(query_create)
@@ -40,9 +42,9 @@ class DbTest(unittest.TestCase):
     @classmethod
     def _populate_table(cls):
         query = 'INSERT INTO orders (row_num, order_id, ' \
-                'price_usd, delivery_data, price_rur) ' \
-                'VALUES (%s, %s, %s, %s, %s);'
-        orders = [(1, x, 500, '12.04.2023', 5000) for x in range(10)]
+                'price_usd, delivery_data) ' \
+                'VALUES (%s, %s, %s, %s);'
+        orders = [(1, x, 500, date(2023, 4, 12)) for x in range(10)]
 
         with cls.conn.cursor() as cur:
             cur.executemany(query, orders)
@@ -50,7 +52,7 @@ class DbTest(unittest.TestCase):
 
     @classmethod
     def _delete_table(cls):
-        query = """DROP TABLE IF EXISTS orders;"""
+        query = """DROP TABLE IF EXISTS orders, currency_rates CASCADE;"""
         with cls.conn.cursor() as cur:
             cur.execute(query)
             cls.conn.commit()
@@ -115,11 +117,31 @@ class TestDBWorker(DbTest):
             cur.execute(query)
             self.assertEqual(0, len(cur.fetchall()))
 
+    def test_delete_missing_orders(self):
+        """
+        testing orders missing in the sheet are deleted in chunks
+        - duplicated ids are allowed
+        - empty sheet deletes everything
+        """
+        deleted = self.worker.delete_missing_orders(
+            iter([0, 1, 1, 5, 42]), chunk_size=2
+        )
+        self.assertEqual([2, 3, 4, 6, 7, 8, 9], sorted(deleted))
+        self.assertEqual([], self.worker.delete_missing_orders([0, 1, 5]))
+        self.assertEqual(
+            [0, 1, 5], sorted(self.worker.retrieve_orders_from_db())
+        )
+
+        self.assertEqual(
+            [0, 1, 5], sorted(self.worker.delete_missing_orders([]))
+        )
+        self.assertEqual([], self.worker.retrieve_orders_from_db())
+
     def test_insert_order_in_db(self):
         """
         testing inserting orders in DB
         """
-        order = [1, 11, 500, '12.04.2023', 5000]
+        order = [1, 11, 500, '12.04.2023']
         res = self.worker.insert_order_in_db(order)
         self.assertEqual(1, res)
 
@@ -135,7 +157,7 @@ class TestDBWorker(DbTest):
         - incorrect data type
         - incorrect order of args
         """
-        order = [1, 9, 500, '12.04.2023', 5000]
+        order = [1, 9, 500, '12.04.2023']
         res = self.worker.insert_order_in_db(order)
         self.assertEqual(0, res)
         query = 'SELECT * FROM orders;'
@@ -144,7 +166,7 @@ class TestDBWorker(DbTest):
             self.assertEqual(10, len(cur.fetchall()))
 
         self._truncate_table()
-        order = [1, '11', 500, '12.04.2023', 5000]
+        order = [1, '11', 500, '12.04.2023']
         res = self.worker.insert_order_in_db(order)
         self.assertEqual(1, res)
         query = 'SELECT * FROM orders;'
@@ -153,7 +175,7 @@ class TestDBWorker(DbTest):
             self.assertEqual(1, len(cur.fetchall()))
 
         self._truncate_table()
-        order = [1, '12.04.2023', 500, 11, 5000]
+        order = [1, '12.04.2023', 500, 11]
         res = self.worker.insert_order_in_db(order)
         self.assertEqual(0, res)
         query = 'SELECT * FROM orders;'
@@ -170,7 +192,7 @@ class TestDBWorker(DbTest):
             cur.execute(query, (1,))
             old_price = cur.fetchone()
 
-        order = [1, 1000, '12.04.2023', 5000, 1]
+        order = [1, 1000, '12.04.2023', 1]
         res = self.worker.update_order_in_db(order)
         self.assertEqual(1, res)
 
@@ -188,7 +210,7 @@ class TestDBWorker(DbTest):
         - incorrect data type
         """
 
-        order = [1, 1000, '12.04.2023', 5000, 11]
+        order = [1, 1000, '12.04.2023', 11]
         res = self.worker.update_order_in_db(order)
         self.assertEqual(1, res)
         query = 'SELECT price_usd FROM orders WHERE order_id = %s;'
@@ -201,7 +223,7 @@ class TestDBWorker(DbTest):
         with self.conn.cursor() as cur:
             cur.execute(query, (1,))
             old_price = cur.fetchone()
-        order = [1, 1000, '12.04.2023', 5000, 1]
+        order = [1, 1000, '12.04.2023', 1]
         res = self.worker.update_order_in_db(order)
         self.assertEqual(1, res)
         query = 'SELECT price_usd FROM orders WHERE order_id = %s;'
@@ -210,3 +232,252 @@ class TestDBWorker(DbTest):
             new_price = cur.fetchone()
         self.assertNotEqual(old_price, new_price)
         self.assertEqual(1000, int(new_price[0]))
+
+    def test_upsert_orders(self):
+        """
+        testing inserting and updating orders in one transaction
+        """
+        orders = [
+            [1, 1, 1000, '12.04.2023'],
+            [2, 11, 500, '12.04.2023'],
+            [3, 12, 500, '12.04.2023'],
+        ]
+        added, updated = self.worker.upsert_orders(orders)
+        self.assertEqual([11, 12], sorted(added))
+        self.assertEqual([1], updated)
+
+        query = 'SELECT price_usd FROM orders WHERE order_id = %s;'
+        with self.conn.cursor() as cur:
+            cur.execute(query, (1,))
+            self.assertEqual(1000, int(cur.fetchone()[0]))
+            cur.execute('SELECT * FROM orders;')
+            self.assertEqual(12, len(cur.fetchall()))
+
+    def test_upsert_orders_negative(self):
+        """
+        testing upserting with negative output
+        - empty list of orders
+        - incorrect data type rolls back the whole batch
+        """
+        self.assertEqual(([], []), self.worker.upsert_orders([]))
+
+        orders = [
+            [1, 11, 500, '12.04.2023'],
+            ['12.04.2023', 12, 500, 1],
+        ]
+        self.assertEqual(([], []), self.worker.upsert_orders(orders))
+        with self.conn.cursor() as cur:
+            cur.execute('SELECT * FROM orders;')
+            self.assertEqual(10, len(cur.fetchall()))
+
+    def test_merge_orders(self):
+        """
+        testing merging orders through staging table
+        - changed rows are updated, equal rows are skipped
+        - new rows are inserted
+        - missing rows are deleted
+        """
+        orders = [
+            [1, 0, 500, '12.04.2023'],
+            [1, 1, 1000, '12.04.2023'],
+            [2, 11, 500, '12.04.2023'],
+        ]
+        added, updated, deleted = self.worker.merge_orders(orders)
+        self.assertEqual([11], added)
+        self.assertEqual([0, 1], sorted(updated))
+        self.assertEqual(([], [], []), self.worker.merge_orders(orders))
+        self.assertEqual([x for x in range(2, 10)], sorted(deleted))
+
+        query = 'SELECT order_id, price_usd FROM orders ORDER BY order_id;'
+        with self.conn.cursor() as cur:
+            cur.execute(query)
+            self.assertEqual(
+                [(0, 500), (1, 1000), (11, 500)],
+                cur.fetchall()
+            )
+
+    def test_merge_orders_negative(self):
+        """
+        testing merging with incorrect data type rolls back everything
+        """
+        orders = [
+            [1, 11, 500, '12.04.2023'],
+            ['12.04.2023', 12, 500, 1],
+        ]
+        self.assertEqual(([], [], []), self.worker.merge_orders(orders))
+        with self.conn.cursor() as cur:
+            cur.execute('SELECT * FROM orders;')
+            self.assertEqual(10, len(cur.fetchall()))
+
+    def test_retrieve_hashes_from_db(self):
+        """
+        testing retrieving content hashes and skipping unchanged orders
+        """
+        self.assertEqual(
+            {x: None for x in range(10)},
+            self.worker.retrieve_hashes_from_db()
+        )
+
+        order = [1, 1, 1000, '12.04.2023']
+        self.assertEqual(([], [1]), self.worker.upsert_orders([order]))
+        self.assertEqual(
+            order_hash(order),
+            self.worker.retrieve_hashes_from_db()[1]
+        )
+        self.assertEqual(([], []), self.worker.upsert_orders([order]))
+
+    def test_db_worker_context_manager(self):
+        """
+        testing pool is closed on exit from with statement
+        """
+        with DBWorker(
+            database='orders_test',
+            host=os.environ.get('POSTGRES_HOST')
+        ) as worker:
+            self.assertEqual(10, len(worker.retrieve_orders_from_db()))
+        self.assertTrue(worker.pg_pool.closed)
+        worker.close()
+
+    def test_getconn_replaces_broken_connection(self):
+        """
+        testing broken connection is not checked out of the pool
+        """
+        worker = DBWorker(
+            database='orders_test',
+            host=os.environ.get('POSTGRES_HOST'),
+            minconn=1,
+            maxconn=2,
+            check_interval=0
+        )
+        conn = worker.getconn()
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_backend_pid();')
+            pid = cur.fetchone()[0]
+        worker.putconn(conn)
+        with self.conn.cursor() as cur:
+            cur.execute('SELECT pg_terminate_backend(%s);', (pid,))
+
+        self.assertEqual(10, len(worker.retrieve_orders_from_db()))
+        worker.close()
+
+    def test_migrate(self):
+        """
+        testing migration of untyped table to the latest version
+        - numbers and dates are converted
+        - unparseable values become NULL
+        - index on delivery_data is created and version is recorded
+        - price_rur is dropped and derived by orders_rur view
+        """
+        self._delete_table()
+        query = (
+            'DROP TABLE IF EXISTS schema_version; '
+            'CREATE TABLE orders '
+            '(id serial PRIMARY KEY, '
+            'row_num integer, '
+            'order_id integer UNIQUE, '
+            'price_usd varchar, '
+            'delivery_data varchar, '
+            'price_rur varchar);'
+        )
+        orders = [
+            (1, 1, '675', '24.05.2022', '56025.0'),
+            (2, 2, 'n/a', '31.02.2022', '???'),
+        ]
+        with self.conn.cursor() as cur:
+            cur.execute(query)
+            cur.executemany(
+                'INSERT INTO orders (row_num, order_id, price_usd, '
+                'delivery_data, price_rur) VALUES (%s, %s, %s, %s, %s);',
+                orders
+            )
+            self.conn.commit()
+
+        self.worker.migrate()
+
+        with self.conn.cursor() as cur:
+            cur.execute(
+                'SELECT order_id, price_usd, delivery_data, price_rur '
+                'FROM orders_rur ORDER BY order_id;'
+            )
+            self.assertEqual(
+                [
+                    (1, Decimal('675'), date(2022, 5, 24), None),
+                    (2, None, None, None),
+                ],
+                cur.fetchall()
+            )
+            cur.execute(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_name = 'orders' AND column_name = 'price_rur';"
+            )
+            self.assertEqual([], cur.fetchall())
+            cur.execute(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE tablename = 'orders' "
+                "AND indexname = 'orders_delivery_data_idx';"
+            )
+            self.assertEqual(1, len(cur.fetchall()))
+            cur.execute('SELECT version FROM schema_version;')
+            self.assertEqual([(3, )], cur.fetchall())
+
+        self.worker.migrate()
+        self.assertEqual(2, len(self.worker.retrieve_hashes_from_db()))
+
+    def test_save_rates(self):
+        """
+        testing rates are saved once and applied to prices by orders_rur
+        - price_rur uses the latest rate
+        - price_rur_on_delivery uses the rate on delivery date
+        """
+        self._delete_table()
+        self.worker.migrate()
+        self._populate_table()
+
+        rates = [(date(2023, 4, 11), 81.5), (date(2023, 4, 13), 82.0)]
+        self.assertEqual(2, self.worker.save_rates('R01235', rates))
+        self.assertEqual(0, self.worker.save_rates('R01235', rates))
+        self.assertEqual(
+            1, self.worker.save_rates('R01235', [(date(2023, 4, 13), 83.0)])
+        )
+
+        query = 'SELECT price_rur, price_rur_on_delivery ' \
+                'FROM orders_rur WHERE order_id = %s;'
+        with self.conn.cursor() as cur:
+            cur.execute(query, (1, ))
+            self.assertEqual(
+                (Decimal('41500.00'), Decimal('40750.00')),
+                cur.fetchone()
+            )
+
+    def test_for_table(self):
+        """
+        testing worker of another table shares the pool,
+        its table is created with its own schema version
+        """
+        with self.conn.cursor() as cur:
+            cur.execute('DROP TABLE IF EXISTS orders_second CASCADE;')
+            self.conn.commit()
+        worker = self.worker.for_table('orders_second')
+        self.assertIs(self.worker.pg_pool, worker.pg_pool)
+        with self.assertRaises(ValueError):
+            self.worker.for_table('orders; DROP TABLE orders')
+
+        worker.migrate()
+        self.assertEqual(
+            ([5], []),
+            worker.upsert_orders([[1, 5, 500, '12.04.2023']])
+        )
+        self.assertEqual([5], worker.retrieve_orders_from_db())
+        self.assertEqual(10, len(self.worker.retrieve_orders_from_db()))
+        with self.conn.cursor() as cur:
+            cur.execute(
+                "SELECT version FROM schema_version "
+                "WHERE table_name = 'orders_second';"
+            )
+            self.assertEqual([(3, )], cur.fetchall())
+            cur.execute(
+                'DROP TABLE orders_second CASCADE; '
+                "DELETE FROM schema_version "
+                "WHERE table_name = 'orders_second';"
+            )
+            self.conn.commit()
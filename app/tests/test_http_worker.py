@@ -1,11 +1,15 @@
+import os
+import tempfile
 import unittest
+from datetime import date
 from unittest.mock import patch, Mock
 
 from freezegun import freeze_time
 
 import responses
+from googleapiclient.errors import HttpError
 
-from http_worker import CurrencyUpdater, ApiHandler
+from http_worker import CurrencyUpdater, ApiHandler, DriveChangeDetector
 
 
 class TestCurrencyUpdater(unittest.TestCase):
@@ -14,6 +18,19 @@ class TestCurrencyUpdater(unittest.TestCase):
     if cbr.ru does not provide any answers return None
     if cbr.ru provides currency return value
     """
+    url = 'https://www.cbr.ru/scripts/XML_dynamic.asp?'\
+          'date_req1=29/03/2023&date_req2=08/04/2023&'\
+          'VAL_NM_RQ=R01235'
+    res_with_currency = (
+        '<?xml version="1.0" encoding="windows-1251"?>'
+        '<ValCurs ID="R01235" DateRange1="29.03.2023" '
+        'DateRange2="08.04.2023" name="Foreign Currency Market Dynamic">'
+        '<Record Date="06.04.2023" Id="R01235">'
+        '<Nominal>1</Nominal><Value>80,5</Value></Record>'
+        '<Record Date="07.04.2023" Id="R01235">'
+        '<Nominal>1</Nominal><Value>79,0</Value></Record>'
+        '</ValCurs>'
+    )
 
     @responses.activate
     @freeze_time("2023-04-08")
@@ -21,53 +38,102 @@ class TestCurrencyUpdater(unittest.TestCase):
         """
         testcase positive outcome
         """
-        url_no_currency = 'https://www.cbr.ru/scripts/XML_dynamic.asp?'\
-                          'date_req1=08/04/2023&date_req2=08/04/2023&'\
-                          'VAL_NM_RQ=R01235'
-        res_no_currency = '</ValCurs>'
-
         responses.add(
             responses.GET,
-            url=url_no_currency,
-            body=res_no_currency
+            url=self.url,
+            body='<ValCurs ID="R01235"></ValCurs>'
         )
-
         res = CurrencyUpdater().retrieve_currency()
         self.assertEqual(None, res)
 
-        url_with_currency = 'https://www.cbr.ru/scripts/XML_dynamic.asp?'\
-                            'date_req1=07/04/2023&date_req2=07/04/2023&'\
-                            'VAL_NM_RQ=R01235'
-        res_with_currency = '<Value>79,0</Value>'
-        responses.add(
+        responses.replace(
             responses.GET,
-            url=url_with_currency,
-            body=res_with_currency
+            url=self.url,
+            body=self.res_with_currency
         )
-        res = CurrencyUpdater().retrieve_currency()
+        updater = CurrencyUpdater()
+        res = updater.retrieve_currency()
         self.assertEqual(79, res)
+        self.assertEqual(2, len(responses.calls))
+        self.assertEqual(
+            [(date(2023, 4, 6), 80.5), (date(2023, 4, 7), 79.0)],
+            updater.retrieve_rates()
+        )
 
     @responses.activate
     @freeze_time("2023-04-08")
     def test_retrieve_currency_negative(self):
         """
-        testcase positive outcome
+        testcase negative outcome
+        - cbr.ru responds with error status
+        - cbr.ru responds with broken XML
         """
-        url_no_currency = 'https://www.cbr.ru/scripts/XML_dynamic.asp?'\
-                          'date_req1=08/04/2023&date_req2=08/04/2023'\
-                          '&VAL_NM_RQ=R01235'
-        res_no_currency = '404 Not Found'
-
         responses.add(
             responses.GET,
-            url=url_no_currency,
-            body=res_no_currency,
+            url=self.url,
+            body='404 Not Found',
             status=404
         )
+        res = CurrencyUpdater().retrieve_currency()
+        self.assertEqual(None, res)
 
+        responses.replace(
+            responses.GET,
+            url=self.url,
+            body='</ValCurs>'
+        )
         res = CurrencyUpdater().retrieve_currency()
         self.assertEqual(None, res)
 
+    @responses.activate
+    def test_retrieve_currency_cache(self):
+        """
+        testcase rate is cached by date for ttl seconds,
+        the whole series warms the cache
+        and cache is restored from cache file
+        """
+        responses.add(
+            responses.GET, url=self.url, body=self.res_with_currency
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, 'currency.json')
+            with freeze_time('2023-04-08 10:00:00'):
+                updater = CurrencyUpdater(ttl=60, cache_file=cache_file)
+                self.assertEqual(79, updater.retrieve_currency())
+                self.assertEqual(79, updater.retrieve_currency())
+                self.assertEqual(
+                    80.5, updater.get_cached_rate(date(2023, 4, 6))
+                )
+                self.assertEqual(
+                    79,
+                    CurrencyUpdater(
+                        ttl=60, cache_file=cache_file
+                    ).retrieve_currency()
+                )
+            self.assertEqual(1, len(responses.calls))
+
+            with freeze_time('2023-04-08 10:02:00'):
+                self.assertEqual(79, updater.retrieve_currency())
+            self.assertEqual(2, len(responses.calls))
+
+    @responses.activate
+    @freeze_time("2023-04-08")
+    def test_retrieve_currency_rate_store(self):
+        """
+        testcase fetched series is saved in rate store once per fetch
+        """
+        responses.add(
+            responses.GET, url=self.url, body=self.res_with_currency
+        )
+        rate_store = Mock()
+        updater = CurrencyUpdater(rate_store=rate_store)
+        self.assertEqual(79, updater.retrieve_currency())
+        self.assertEqual(79, updater.retrieve_currency())
+        rate_store.save_rates.assert_called_once_with(
+            'R01235', [(date(2023, 4, 6), 80.5), (date(2023, 4, 7), 79.0)]
+        )
+
 
 class TestApiHandler(unittest.TestCase):
     """
@@ -78,18 +144,27 @@ class TestApiHandler(unittest.TestCase):
         self.google_cred = 'cred'
         self.spreadsheet_id = 'spreadsheet_id'
 
+    @staticmethod
+    def _set_row_count(mock_build, row_count):
+        mock_build.return_value.spreadsheets.return_value.\
+            get.return_value.execute.return_value = {
+                'sheets': [
+                    {'properties': {'gridProperties': {
+                        'rowCount': row_count
+                    }}}
+                ]
+            }
+
     @patch('http_worker.build')
     @patch('http_worker.ServiceAccountCredentials')
     def test_retrieve_orders_one_request(self,
                                          mock_ServiceAccountCredentials,
                                          mock_build):
         """
-        testing retrieving rows requires one request
+        testing sheet without data rows requires only metadata request
         """
 
-        mock_build.return_value.spreadsheets.return_value.\
-            values.return_value.get.return_value.\
-            execute.return_value = {'values': []}
+        self._set_row_count(mock_build, 1)
         res = ApiHandler(
             self.google_cred, self.spreadsheet_id
         ).retrieve_orders()
@@ -98,6 +173,8 @@ class TestApiHandler(unittest.TestCase):
             self.google_cred,
             *mock_ServiceAccountCredentials.from_json_keyfile_name.call_args
         )
+        mock_build.return_value.spreadsheets.return_value.\
+            values.return_value.batchGet.assert_not_called()
 
     @patch('http_worker.build')
     @patch('http_worker.ServiceAccountCredentials')
@@ -106,21 +183,28 @@ class TestApiHandler(unittest.TestCase):
                                           mock_build):
         """
         testing retrieving rows requires more than one request
+        and one service is built
         """
 
-        mock_build_res = Mock()
-        mock_build_res.side_effect = [
-            {'values': [1, 2, 3]},
-            {'values': [4, 5, 6]},
-            {'values': []}
+        self._set_row_count(mock_build, 7)
+        mock_batch_get = mock_build.return_value.spreadsheets.\
+            return_value.values.return_value.batchGet
+        mock_batch_get.return_value.execute.side_effect = [
+            {'valueRanges': [{'values': [1, 2]}, {'values': [3, 4]}]},
+            {'valueRanges': [{'values': [5, 6]}]},
         ]
-        mock_build.return_value.spreadsheets.return_value.\
-            values.return_value.get.return_value.\
-            execute = mock_build_res
         res = ApiHandler(
-            self.google_cred, self.spreadsheet_id
+            self.google_cred, self.spreadsheet_id,
+            page_size=2, batch_size=2
         ).retrieve_orders()
         self.assertEqual([1, 2, 3, 4, 5, 6], res)
+        self.assertEqual(1, mock_build.call_count)
+        self.assertEqual(
+            ['2:3', '4:5'], mock_batch_get.call_args_list[0][1]['ranges']
+        )
+        self.assertEqual(
+            ['6:7'], mock_batch_get.call_args_list[1][1]['ranges']
+        )
 
     @patch('http_worker.build')
     @patch('http_worker.ServiceAccountCredentials')
@@ -131,12 +215,77 @@ class TestApiHandler(unittest.TestCase):
         testing raising exception while retrieving rows
         """
 
+        self._set_row_count(mock_build, 7)
         mock_build_res = Mock()
         mock_build_res.side_effect = TimeoutError
         mock_build.return_value.spreadsheets.\
-            return_value.values.return_value.get.\
+            return_value.values.return_value.batchGet.\
             return_value.execute = mock_build_res
         res = ApiHandler(
             self.google_cred, self.spreadsheet_id
         ).retrieve_orders()
         self.assertEqual(None, res)
+        self.assertEqual(
+            1, mock_ServiceAccountCredentials.from_json_keyfile_name.call_count
+        )
+
+    @patch('http_worker.build')
+    @patch('http_worker.ServiceAccountCredentials')
+    def test_retrieve_orders_parallel(self,
+                                      mock_ServiceAccountCredentials,
+                                      mock_build):
+        """
+        testing parallel retrieving keeps sheet order
+        and returns None if any chunk fails
+        """
+
+        self._set_row_count(mock_build, 9)
+
+        def batch_get(spreadsheetId, ranges, majorDimension):
+            request = Mock()
+            if ranges == ['8:9']:
+                request.execute.side_effect = HttpError(Mock(), b'')
+            else:
+                request.execute.return_value = {'valueRanges': [
+                    {'values': [range_]} for range_ in ranges
+                ]}
+            return request
+
+        mock_build.return_value.spreadsheets.return_value.\
+            values.return_value.batchGet.side_effect = batch_get
+        handler = ApiHandler(
+            self.google_cred, self.spreadsheet_id,
+            page_size=2, batch_size=1, concurrency=3
+        )
+        self.assertIsNone(handler.retrieve_orders())
+
+        self._set_row_count(mock_build, 7)
+        self.assertEqual(
+            ['2:3', '4:5', '6:7'], handler.retrieve_orders()
+        )
+
+
+class TestDriveChangeDetector(unittest.TestCase):
+    """
+    testcase for testing drive file version detection
+    """
+
+    @patch('http_worker.build')
+    @patch('http_worker.ServiceAccountCredentials')
+    def test_retrieve_version(self,
+                              mock_ServiceAccountCredentials,
+                              mock_build):
+        """
+        testing version is returned and None on errors
+        """
+        mock_get = mock_build.return_value.files.return_value.get
+        mock_get.return_value.execute.side_effect = [
+            {'version': '42'}, TimeoutError
+        ]
+        detector = DriveChangeDetector('cred', 'spreadsheet_id')
+        self.assertEqual('42', detector.retrieve_version())
+        self.assertIsNone(detector.retrieve_version())
+        self.assertEqual(1, mock_build.call_count)
+        mock_get.assert_called_with(
+            fileId='spreadsheet_id', fields='version'
+        )
@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import unittest
+
+from http_worker import Logger
+from log_writer import LogWriter
+
+
+class TestLogWriter(unittest.TestCase):
+    """
+    testcase for testing LogWriter:
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'log.txt')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write(self):
+        """
+        testing entries are written in background in plain text
+        """
+        writer = LogWriter(path=self.path, flush_interval=0.01)
+        writer.write('retrieve_orders', ' timed out ')
+        writer.write('retrieve_currency', 'Status codes of responses 500')
+        writer.flush()
+        with open(self.path) as log:
+            text = log.read()
+        self.assertIn(
+            'While executing function --- RETRIEVE_ORDERS --- error occurs:'
+            '\n--- timed out ---\n',
+            text
+        )
+        self.assertEqual(2, text.count('log datatime: '))
+
+    def test_write_json_lines(self):
+        """
+        testing entries are written as JSON lines
+        """
+        writer = LogWriter(
+            path=self.path, json_lines=True, flush_interval=0.01
+        )
+        for number in range(5):
+            writer.write('sync', number)
+        writer.flush()
+        with open(self.path) as log:
+            entries = [json.loads(line) for line in log]
+        self.assertEqual(
+            [str(number) for number in range(5)],
+            [entry['error'] for entry in entries]
+        )
+        self.assertEqual({'sync'}, {entry['function'] for entry in entries})
+
+    def test_rotate(self):
+        """
+        testing log file is rotated by size keeping backup_count files
+        """
+        writer = LogWriter(
+            path=self.path, json_lines=True, max_bytes=200,
+            backup_count=2, batch_size=1, flush_interval=0.01
+        )
+        for number in range(20):
+            writer.write('sync', 'x' * 50)
+        writer.flush()
+        self.assertTrue(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(f'{self.path}.1'))
+        self.assertTrue(os.path.exists(f'{self.path}.2'))
+        self.assertFalse(os.path.exists(f'{self.path}.3'))
+        self.assertLessEqual(os.path.getsize(self.path), 200)
+
+    def test_write_queue_full(self):
+        """
+        testing entries are dropped instead of blocking when queue is full
+        """
+        writer = LogWriter(path=self.path, max_queue=1)
+        writer.start = lambda: None
+        writer.write('sync', 1)
+        writer.write('sync', 2)
+        self.assertEqual(1, writer.dropped)
+
+    def test_log_error(self):
+        """
+        testing Logger captures name of the calling function
+        """
+        writer = LogWriter(
+            path=self.path, json_lines=True, flush_interval=0.01
+        )
+        log_writer, Logger.log_writer = Logger.log_writer, writer
+        try:
+            def retrieve_something():
+                Logger.log_error('error')
+            retrieve_something()
+            Logger.write_log('sync', 'error')
+        finally:
+            Logger.log_writer = log_writer
+        writer.flush()
+        with open(self.path) as log:
+            entries = [json.loads(line) for line in log]
+        self.assertEqual(
+            ['retrieve_something', 'sync'],
+            [entry['function'] for entry in entries]
+        )
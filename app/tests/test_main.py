@@ -1,7 +1,24 @@
+import time
 import unittest
-from unittest.mock import patch
+from datetime import date
+from decimal import Decimal
+from unittest.mock import Mock, patch
 
-from main import main
+from db_worker import order_hash, parse_order
+from http_worker import ChangeDetector
+from main import main, parse_sources
+from scheduler import Scheduler
+
+
+class FakeChangeDetector(ChangeDetector):
+    """
+    Local change detector returns given versions one by one
+    """
+    def __init__(self, versions):
+        self.versions = iter(versions)
+
+    def retrieve_version(self):
+        return next(self.versions)
 
 
 class TestMain(unittest.TestCase):
@@ -9,6 +26,9 @@ class TestMain(unittest.TestCase):
     testcase for testing main:
     """
 
+    def setUp(self):
+        self.scheduler = Scheduler(sleep=Mock(), jitter=0)
+
     @patch('main.DBWorker')
     @patch('main.ApiHandler')
     @patch('main.CurrencyUpdater')
@@ -29,36 +49,41 @@ class TestMain(unittest.TestCase):
             ['2', '1182407', '214', '13.05.2022'],
             ['3', '1120833', '610', '05.05.2022'],
         ]
-        mock_DBWorker().retrieve_orders_from_db.return_value = [1249708, 4]
-        mock_DBWorker().update_order_in_db.return_value = 1
-        mock_DBWorker().insert_order_in_db.return_value = 1
-        mock_DBWorker().delete_orders_from_db.return_value = 1
+        mock_DBWorker().retrieve_hashes_from_db.return_value = {
+            1249708: None, 4: None
+        }
+        mock_DBWorker().upsert_orders.return_value = (
+            [1182407, 1120833], [1249708]
+        )
+        mock_DBWorker().delete_missing_orders.return_value = [4]
 
         google_cred = 'cred'
         spreadsheet_id = 'spreadsheet_id'
         with self.assertRaises(KeyError):
-            main(google_cred, spreadsheet_id)
+            main(google_cred, spreadsheet_id, scheduler=self.scheduler)
 
         self.assertEqual(
             2,
             mock_CurrencyUpdater().retrieve_currency.call_count
         )
-        self.assertEqual(1, mock_ApiHandler().retrieve_orders.call_count)
+        # the second cycle fetches sheet and DB concurrently with currency
+        self.assertEqual(2, mock_ApiHandler().retrieve_orders.call_count)
+        self.assertEqual(2, mock_DBWorker().retrieve_hashes_from_db.call_count)
+        self.assertEqual(1, mock_DBWorker().upsert_orders.call_count)
+        mock_DBWorker().upsert_orders.assert_called_with([
+            [1, 1249708, 675, date(2022, 5, 24)],
+            [2, 1182407, 214, date(2022, 5, 13)],
+            [3, 1120833, 610, date(2022, 5, 5)],
+        ])
+        mock_DBWorker().close.assert_called_once_with()
 
-        self.assertEqual(1, mock_DBWorker().retrieve_orders_from_db.call_count)
-        self.assertEqual(1, mock_DBWorker().update_order_in_db.call_count)
-        mock_DBWorker().update_order_in_db.assert_called_with(
-            ['1', '675', '24.05.2022', 56025.0, '1249708']
-        )
-
-        self.assertEqual(2, mock_DBWorker().insert_order_in_db.call_count)
-        mock_DBWorker().insert_order_in_db.assert_called_with(
-            ['3', '1120833', '610', '05.05.2022', 50630.0]
+        # vanished order 4 is deleted by ids which are still in the sheet
+        self.assertEqual(1, mock_DBWorker().delete_missing_orders.call_count)
+        self.assertEqual(
+            [1249708, 1182407, 1120833],
+            list(mock_DBWorker().delete_missing_orders.call_args.args[0])
         )
 
-        self.assertEqual(1, mock_DBWorker().delete_orders_from_db.call_count)
-        mock_DBWorker().delete_orders_from_db.assert_called_with([4])
-
     @patch('main.DBWorker')
     @patch('main.ApiHandler')
     @patch('main.CurrencyUpdater')
@@ -73,21 +98,18 @@ class TestMain(unittest.TestCase):
         """
         mock_CurrencyUpdater().retrieve_currency.side_effect = [83, KeyError]
         mock_ApiHandler().retrieve_orders.return_value = []
-        mock_DBWorker().retrieve_orders_from_db.return_value = []
-        mock_DBWorker().update_order_in_db.return_value = 1
-        mock_DBWorker().insert_order_in_db.return_value = 1
-        mock_DBWorker().delete_orders_from_db.return_value = 1
+        mock_DBWorker().retrieve_hashes_from_db.return_value = {}
+        mock_DBWorker().upsert_orders.return_value = ([], [])
+        mock_DBWorker().delete_missing_orders.return_value = [4]
 
         google_cred = 'cred'
         spreadsheet_id = 'spreadsheet_id'
         with self.assertRaises(KeyError):
-            main(google_cred, spreadsheet_id)
+            main(google_cred, spreadsheet_id, scheduler=self.scheduler)
 
-        mock_DBWorker().insert_order_in_db.assert_not_called()
-        mock_DBWorker().retrieve_orders_from_db.assert_not_called()
-        mock_DBWorker().update_order_in_db.assert_not_called()
-        mock_DBWorker().insert_order_in_db.assert_not_called()
-        mock_DBWorker().delete_orders_from_db.assert_not_called()
+        mock_DBWorker().upsert_orders.assert_not_called()
+        mock_DBWorker().delete_missing_orders.assert_not_called()
+        self.scheduler.sleep.assert_called_once_with(5)
 
     @patch('main.DBWorker')
     @patch('main.ApiHandler')
@@ -99,24 +121,246 @@ class TestMain(unittest.TestCase):
                                                  mock_ApiHandler,
                                                  mock_DBWorker):
         """
-        negative testcase when cbr.ru returns None
+        negative testcase when cbr.ru returns None,
+        orders are written anyway
         """
         mock_CurrencyUpdater().retrieve_currency.side_effect = [None, KeyError]
         mock_ApiHandler().retrieve_orders.return_value = [
             ['1', '1249708', '675', '24.05.2022'],
         ]
 
-        mock_DBWorker().retrieve_orders_from_db.return_value = []
-        mock_DBWorker().update_order_in_db.return_value = 1
-        mock_DBWorker().insert_order_in_db.return_value = 1
-        mock_DBWorker().delete_orders_from_db.return_value = 1
+        mock_DBWorker().retrieve_hashes_from_db.return_value = {}
+        mock_DBWorker().upsert_orders.return_value = ([], [])
+        mock_DBWorker().delete_missing_orders.return_value = [4]
+
+        google_cred = 'cred'
+        spreadsheet_id = 'spreadsheet_id'
+        with self.assertRaises(KeyError):
+            main(google_cred, spreadsheet_id, scheduler=self.scheduler)
+
+        self.assertEqual(1, mock_DBWorker().upsert_orders.call_count)
+        mock_DBWorker().upsert_orders.assert_called_with(
+            [[1, 1249708, 675, date(2022, 5, 24)]]
+        )
+
+    @patch('main.DBWorker')
+    @patch('main.ApiHandler')
+    @patch('main.CurrencyUpdater')
+    @patch('builtins.print')
+    def test_retrieve_currency_copy_mode(self,
+                                         mock_print,
+                                         mock_CurrencyUpdater,
+                                         mock_ApiHandler,
+                                         mock_DBWorker):
+        """
+        testcase sheet size reaches copy threshold
+        """
+        mock_CurrencyUpdater().retrieve_currency.side_effect = [83, KeyError]
+        mock_ApiHandler().retrieve_orders.return_value = [
+            ['1', '1249708', '675', '24.05.2022'],
+            ['2', '1182407', '214', '13.05.2022'],
+        ]
+        mock_DBWorker().merge_orders.return_value = ([1182407], [], [4])
+
+        google_cred = 'cred'
+        spreadsheet_id = 'spreadsheet_id'
+        with self.assertRaises(KeyError):
+            main(
+                google_cred, spreadsheet_id,
+                copy_threshold=2, scheduler=self.scheduler
+            )
+
+        self.assertEqual(1, mock_DBWorker().merge_orders.call_count)
+        self.assertEqual(
+            [
+                [1, 1249708, 675, date(2022, 5, 24)],
+                [2, 1182407, 214, date(2022, 5, 13)],
+            ],
+            list(mock_DBWorker().merge_orders.call_args.args[0])
+        )
+        mock_DBWorker().upsert_orders.assert_not_called()
+        mock_DBWorker().delete_missing_orders.assert_not_called()
+
+    @patch('main.DBWorker')
+    @patch('main.ApiHandler')
+    @patch('main.CurrencyUpdater')
+    @patch('builtins.print')
+    def test_retrieve_currency_unchanged_rows(self,
+                                              mock_print,
+                                              mock_CurrencyUpdater,
+                                              mock_ApiHandler,
+                                              mock_DBWorker):
+        """
+        testcase rows with stored content hash are not written
+        """
+        mock_CurrencyUpdater().retrieve_currency.side_effect = [83, KeyError]
+        mock_ApiHandler().retrieve_orders.return_value = [
+            ['1', '1249708', '675', '24.05.2022'],
+            ['2', '1182407', '214', '13.05.2022'],
+        ]
+        mock_DBWorker().retrieve_hashes_from_db.return_value = {
+            1249708: order_hash(
+                parse_order(['1', '1249708', '675', '24.05.2022'])
+            ),
+            1182407: 'outdated',
+        }
+        mock_DBWorker().upsert_orders.return_value = ([], [1182407])
+
+        google_cred = 'cred'
+        spreadsheet_id = 'spreadsheet_id'
+        with self.assertRaises(KeyError):
+            main(google_cred, spreadsheet_id, scheduler=self.scheduler)
+
+        mock_DBWorker().upsert_orders.assert_called_once_with(
+            [[2, 1182407, 214, date(2022, 5, 13)]]
+        )
+        mock_DBWorker().delete_missing_orders.assert_not_called()
+
+    @patch('main.DBWorker')
+    @patch('main.ApiHandler')
+    @patch('main.CurrencyUpdater')
+    @patch('builtins.print')
+    def test_retrieve_currency_not_changed(self,
+                                           mock_print,
+                                           mock_CurrencyUpdater,
+                                           mock_ApiHandler,
+                                           mock_DBWorker):
+        """
+        testcase cycle is skipped while version is the same,
+        new currency rate doesn't rewrite orders
+        """
+        mock_CurrencyUpdater().retrieve_currency.side_effect = [
+            83, 83, 84, 84, KeyError
+        ]
+        mock_ApiHandler().retrieve_orders.return_value = [
+            ['1', '1249708', '675', '24.05.2022'],
+        ]
+        mock_DBWorker().retrieve_hashes_from_db.return_value = {}
+        mock_DBWorker().upsert_orders.return_value = ([1249708], [])
+
+        google_cred = 'cred'
+        spreadsheet_id = 'spreadsheet_id'
+        with self.assertRaises(KeyError):
+            main(
+                google_cred, spreadsheet_id,
+                change_detector=FakeChangeDetector(['1', '1', '1', '2', '2']),
+                scheduler=self.scheduler
+            )
+
+        self.assertEqual(
+            5, mock_CurrencyUpdater().retrieve_currency.call_count
+        )
+        self.assertEqual(2, mock_ApiHandler().retrieve_orders.call_count)
+        self.assertEqual(2, mock_DBWorker().upsert_orders.call_count)
+
+    @patch('main.DBWorker')
+    @patch('main.ApiHandler')
+    @patch('main.CurrencyUpdater')
+    @patch('builtins.print')
+    def test_retrieve_currency_time_budget(self,
+                                           mock_print,
+                                           mock_CurrencyUpdater,
+                                           mock_ApiHandler,
+                                           mock_DBWorker):
+        """
+        testcase cycle exceeding time budget is treated as failed
+        """
+        mock_CurrencyUpdater().retrieve_currency.side_effect = [83, KeyError]
+        mock_ApiHandler().retrieve_orders.side_effect = \
+            lambda: time.sleep(0.2)
+
+        google_cred = 'cred'
+        spreadsheet_id = 'spreadsheet_id'
+        self.scheduler.max_cycle_time = 0.05
+        with self.assertRaises(KeyError):
+            main(google_cred, spreadsheet_id, scheduler=self.scheduler)
+
+        mock_DBWorker().upsert_orders.assert_not_called()
+        self.scheduler.sleep.assert_called_once_with(5)
+
+    @patch('main.DBWorker')
+    @patch('main.ApiHandler')
+    @patch('main.CurrencyUpdater')
+    @patch('builtins.print')
+    def test_retrieve_currency_invalid_rows(self,
+                                            mock_print,
+                                            mock_CurrencyUpdater,
+                                            mock_ApiHandler,
+                                            mock_DBWorker):
+        """
+        testcase rows without order id are skipped,
+        unparseable price and date are written as None
+        """
+        mock_CurrencyUpdater().retrieve_currency.side_effect = [83, KeyError]
+        mock_ApiHandler().retrieve_orders.return_value = [
+            ['1', 'abc', '675', '24.05.2022'],
+            ['2', '1182407', 'n/a', '31.02.2022'],
+            ['3', '1120833', '610,5'],
+        ]
+        mock_DBWorker().retrieve_hashes_from_db.return_value = {}
+        mock_DBWorker().upsert_orders.return_value = ([], [])
 
         google_cred = 'cred'
         spreadsheet_id = 'spreadsheet_id'
         with self.assertRaises(KeyError):
-            main(google_cred, spreadsheet_id)
+            main(google_cred, spreadsheet_id, scheduler=self.scheduler)
+
+        mock_DBWorker().migrate.assert_called_once_with()
+        mock_DBWorker().upsert_orders.assert_called_once_with([
+            [2, 1182407, None, None],
+            [3, 1120833, Decimal('610.5'), None],
+        ])
+
+    @patch('main.DBWorker')
+    @patch('main.ApiHandler')
+    @patch('main.CurrencyUpdater')
+    @patch('builtins.print')
+    def test_retrieve_currency_multiple_spreadsheets(self,
+                                                     mock_print,
+                                                     mock_CurrencyUpdater,
+                                                     mock_ApiHandler,
+                                                     mock_DBWorker):
+        """
+        testcase spreadsheets are synced in their tables,
+        currency is requested once per cycle
+        and failed spreadsheet doesn't stop the others
+        """
+        handlers = {'first': Mock(), 'second': Mock()}
+        mock_ApiHandler.side_effect = \
+            lambda google_cred, spreadsheet_id, *args, **kwargs: \
+            handlers[spreadsheet_id]
+        handlers['first'].retrieve_orders.return_value = [
+            ['1', '1249708', '675', '24.05.2022'],
+        ]
+        handlers['second'].retrieve_orders.side_effect = RuntimeError
+        mock_CurrencyUpdater().retrieve_currency.side_effect = [83, KeyError]
+        mock_DBWorker().retrieve_hashes_from_db.return_value = {}
+        mock_DBWorker().upsert_orders.return_value = ([1249708], [])
+
+        google_cred = 'cred'
+        with self.assertRaises(KeyError):
+            main(
+                google_cred, 'first',
+                sources={'first': 'orders', 'second': 'orders_second'},
+                scheduler=self.scheduler
+            )
+
+        self.assertEqual(
+            2, mock_CurrencyUpdater().retrieve_currency.call_count
+        )
+        self.assertEqual(2, handlers['first'].retrieve_orders.call_count)
+        self.assertEqual(2, handlers['second'].retrieve_orders.call_count)
+        self.assertEqual(2, mock_DBWorker().upsert_orders.call_count)
+        mock_DBWorker().for_table.assert_any_call('orders')
+        mock_DBWorker().for_table.assert_any_call('orders_second')
+        self.assertEqual(2, mock_DBWorker().for_table().migrate.call_count)
+        self.assertNotEqual(5, self.scheduler.sleep.call_args.args[0])
 
-        self.assertEqual(1, mock_DBWorker().insert_order_in_db.call_count)
-        mock_DBWorker().insert_order_in_db.assert_called_with(
-            ['1', '1249708', '675', '24.05.2022', '???']
+    def test_parse_sources(self):
+        """
+        testcase tables of spreadsheets are parsed or derived from ids
+        """
+        self.assertEqual(
+            {'1aB-c': 'orders', '2dE': 'orders_2de', '3': 'orders_x'},
+            parse_sources('1aB-c, 2dE,3:orders_x,')
         )
@@ -0,0 +1,81 @@
+import unittest
+import urllib.error
+import urllib.request
+
+from metrics import Counter, Gauge, Histogram, MetricsServer, Registry
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    testcase for testing metrics in Prometheus text format:
+    """
+
+    def setUp(self):
+        self.registry = Registry()
+        self.counter = self.registry.register(
+            Counter('retries_total', 'Retries', ['upstream'])
+        )
+        self.gauge = self.registry.register(
+            Gauge('pool_connections', 'Connections', ['state'])
+        )
+        self.histogram = self.registry.register(
+            Histogram('stage_seconds', 'Stages', ['stage'], buckets=(1, 5))
+        )
+
+    def test_render(self):
+        """
+        testing rendering of counter, gauge and histogram
+        """
+        self.counter.inc(upstream='cbr')
+        self.counter.inc(2, upstream='cbr')
+        self.gauge.set_function(lambda: {('used', ): 1, ('idle', ): 2})
+        self.histogram.observe(0.5, stage='db_read')
+        self.histogram.observe(3, stage='db_read')
+        self.histogram.observe(7, stage='db_read')
+
+        text = self.registry.render()
+        self.assertIn('# TYPE retries_total counter\n', text)
+        self.assertIn('retries_total{upstream="cbr"} 3\n', text)
+        self.assertIn('pool_connections{state="idle"} 2\n', text)
+        self.assertIn('pool_connections{state="used"} 1\n', text)
+        self.assertIn('# TYPE stage_seconds histogram\n', text)
+        self.assertIn('stage_seconds_bucket{stage="db_read",le="1"} 1\n', text)
+        self.assertIn('stage_seconds_bucket{stage="db_read",le="5"} 2\n', text)
+        self.assertIn(
+            'stage_seconds_bucket{stage="db_read",le="+Inf"} 3\n', text
+        )
+        self.assertIn('stage_seconds_sum{stage="db_read"} 10.5\n', text)
+        self.assertIn('stage_seconds_count{stage="db_read"} 3\n', text)
+
+    def test_time(self):
+        """
+        testing duration of block is observed even if it raises
+        """
+        with self.assertRaises(KeyError):
+            with self.histogram.time(stage='sheet_fetch'):
+                raise KeyError
+        self.assertIn(
+            'stage_seconds_count{stage="sheet_fetch"} 1\n',
+            self.registry.render()
+        )
+
+    def test_server(self):
+        """
+        testing metrics are served on /metrics only
+        """
+        self.counter.inc(upstream='sheets')
+        server = MetricsServer(
+            port=0, host='127.0.0.1', registry=self.registry
+        ).start()
+        try:
+            url = f'http://127.0.0.1:{server.port}'
+            with urllib.request.urlopen(f'{url}/metrics') as response:
+                self.assertEqual(200, response.status)
+                self.assertIn(
+                    'retries_total{upstream="sheets"} 1',
+                    response.read().decode()
+                )
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f'{url}/other')
+        finally:
+            server.stop()
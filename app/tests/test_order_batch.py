@@ -0,0 +1,84 @@
+import unittest
+from datetime import date
+from decimal import Decimal
+
+from db_worker import order_hash, parse_order
+from order_batch import OrderBatch
+
+
+class TestOrderBatch(unittest.TestCase):
+    """
+    testcase for testing OrderBatch
+    """
+    rows = [
+        ['1', '1249708', '675', '24.05.2022'],
+        ['2', '1182407', '214,5', '24.05.2022'],
+        ['3', '1120833', 'n/a', '31.02.2022'],
+        ['4', '1060503', '1 200'],
+    ]
+
+    def test_from_rows(self):
+        """
+        testing rows are converted to typed columns
+        - missing and unparseable values become None
+        - distinct dates are parsed once
+        """
+        batch, skipped = OrderBatch.from_rows(self.rows)
+        self.assertEqual([], skipped)
+        self.assertEqual(4, len(batch))
+        self.assertEqual(
+            [
+                [1, 1249708, Decimal('675'), date(2022, 5, 24)],
+                [2, 1182407, Decimal('214.5'), date(2022, 5, 24)],
+                [3, 1120833, None, None],
+                [4, 1060503, Decimal('1200'), None],
+            ],
+            list(batch.values())
+        )
+        self.assertEqual(3, len(batch.dates))
+        self.assertEqual([1120833, 1060503], batch.incomplete())
+        self.assertEqual(1182407, batch[1].order_id)
+        self.assertEqual(1060503, batch[-1].order_id)
+        with self.assertRaises(IndexError):
+            batch[4]
+
+    def test_from_rows_invalid(self):
+        """
+        testing rows without integer row number or order id are skipped
+        """
+        rows = [
+            ['1', 'abc', '675', '24.05.2022'],
+            ['x', '1182407', '214', '13.05.2022'],
+            ['3', '1120833', '610', '05.05.2022'],
+            [],
+        ]
+        batch, skipped = OrderBatch.from_rows(rows)
+        self.assertEqual(rows[:2] + rows[3:], skipped)
+        self.assertEqual(
+            [[3, 1120833, Decimal('610'), date(2022, 5, 5)]],
+            list(batch.values())
+        )
+        self.assertEqual(0, len(OrderBatch.from_rows([])[0]))
+
+    def test_changed(self):
+        """
+        testing hashes are compatible with rows parsed one by one,
+        only changed rows are returned and vanished ids are found
+        """
+        batch, _ = OrderBatch.from_rows(self.rows)
+        hashes = {
+            int(row[1]): order_hash(parse_order(row)) for row in self.rows
+        }
+        self.assertEqual([], batch.changed(hashes))
+
+        hashes[1182407] = 'outdated'
+        del hashes[1120833]
+        hashes[5] = 'vanished'
+        self.assertEqual(
+            [
+                [2, 1182407, Decimal('214.5'), date(2022, 5, 24)],
+                [3, 1120833, None, None],
+            ],
+            batch.changed(hashes)
+        )
+        self.assertEqual([5], batch.vanished(hashes))
@@ -0,0 +1,74 @@
+import unittest
+from unittest.mock import Mock
+
+from scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    """
+    testcase for testing Scheduler:
+    """
+
+    def setUp(self):
+        self.clock = Mock(return_value=100)
+        self.scheduler = Scheduler(
+            interval=60, retry_delay=5, backoff=2, max_backoff=30,
+            jitter=0, max_cycle_time=20, sleep=Mock(), clock=self.clock
+        )
+
+    def test_delay_success(self):
+        """
+        testing next cycle starts interval after start of the current one
+        """
+        self.scheduler.start_cycle()
+        self.clock.return_value = 110
+        self.assertEqual(50, self.scheduler.delay(True))
+
+        self.clock.return_value = 200
+        self.assertEqual(0, self.scheduler.delay(True))
+
+    def test_delay_failure(self):
+        """
+        testing exponential backoff limited by max_backoff
+        and reset after success
+        """
+        self.scheduler.start_cycle()
+        delays = [self.scheduler.delay(False) for _ in range(5)]
+        self.assertEqual([5, 10, 20, 30, 30], delays)
+
+        self.scheduler.delay(True)
+        self.assertEqual(5, self.scheduler.delay(False))
+
+    def test_delay_jitter(self):
+        """
+        testing jitter keeps delay within the range
+        """
+        self.scheduler.jitter = 0.1
+        for _ in range(100):
+            self.scheduler.start_cycle()
+            self.assertTrue(54 <= self.scheduler.delay(True) <= 66)
+
+    def test_remaining(self):
+        """
+        testing remaining cycle time budget
+        """
+        self.scheduler.start_cycle()
+        self.clock.return_value = 115
+        self.assertEqual(5, self.scheduler.remaining())
+        self.clock.return_value = 130
+        self.assertEqual(0, self.scheduler.remaining())
+
+        self.scheduler.max_cycle_time = None
+        self.assertIsNone(self.scheduler.remaining())
+
+    def test_wait(self):
+        """
+        testing waiting calls sleep only with positive delay
+        """
+        self.scheduler.start_cycle()
+        self.scheduler.wait(True)
+        self.scheduler.sleep.assert_called_once_with(60)
+
+        self.clock.return_value = 200
+        self.scheduler.wait(True)
+        self.assertEqual(1, self.scheduler.sleep.call_count)